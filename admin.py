@@ -0,0 +1,49 @@
+"""
+Admin-only pages of the exam apps.
+
+Opened by adding a query parameter to the app URL and unlocked for the
+session with st.secrets["admin"]["passcode"]:
+    ?footprint      session memory report (session_footprint.py)
+    ?traces         storage and SMTP call timings (tracing.py)
+"""
+import hmac
+
+
+def is_admin(secrets, passcode):
+    expected = str(secrets["admin"]["passcode"]) if "admin" in secrets else ""
+    return bool(expected) and hmac.compare_digest(str(passcode), expected)
+
+
+def require_admin(secrets):
+    """
+    Asks for the admin passcode once per session. Returns True when the
+    session is unlocked.
+    """
+    import streamlit as st
+
+    if st.session_state.get("admin_unlocked"):
+        return True
+    passcode = st.text_input("Admin Passcode", type="password")
+    if not passcode:
+        return False
+    if not is_admin(secrets, passcode):
+        st.error("Invalid admin passcode.")
+        return False
+    st.session_state.admin_unlocked = True
+    return True
+
+
+def admin_page(secrets, query_params):
+    """
+    Renders the admin page named in query_params and returns True, or
+    returns False when none is requested.
+    """
+    from session_footprint import footprint_page
+    from tracing import traces_page
+
+    pages = {"footprint": footprint_page, "traces": traces_page}
+    for name, page in pages.items():
+        if name in query_params:
+            page(secrets)
+            return True
+    return False
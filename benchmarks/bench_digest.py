@@ -0,0 +1,112 @@
+"""
+Throughput of review-email delivery: per-completion emails vs. per-recipient digests.
+
+    direct      the old path: render one document and send it over a fresh
+                SMTP connection (connect + login) for every completion
+    outbox      one document and one message per completion, queued in the
+                outbox and sent over one pooled connection
+    digest      items collected per recipient, one multi-question document
+                and one message per recipient
+
+Mail goes to a local aiosmtpd server (pip install aiosmtpd); storage is the
+in-memory SQLite backend. Run from the repository root:
+    python benchmarks/bench_digest.py [--completions 200] [--recipients 20]
+"""
+import argparse
+import datetime
+import os
+import smtplib
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from aiosmtpd.controller import Controller  # noqa: E402
+
+from bench_sampler import synthetic_bank  # noqa: E402
+from outbox import SMTPPool, build_message, drain_outbox, enqueue_email  # noqa: E402
+from review_digest import enqueue_review_item, flush_digests  # noqa: E402
+from review_doc import render_review_doc  # noqa: E402
+from storage import LocalStorage  # noqa: E402
+
+HOST, PORT = "127.0.0.1", 8025
+
+
+class CountingHandler:
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages += 1
+        self.bytes += len(envelope.content)
+        return "250 OK"
+
+
+def completions(df, n, recipients):
+    for i in range(n):
+        row = df.iloc[i % len(df)]
+        yield f"preceptor{i % recipients}@example.org", f"Student {i}", row, "a"
+
+
+def settings():
+    return {"host": HOST, "port": PORT, "ssl": False, "starttls": False,
+            "username": "", "password": "", "from_email": "portal@example.org"}
+
+
+def run_direct(df, args):
+    for recipient, student, row, letter in completions(df, args.completions, args.recipients):
+        record = {"to": [recipient], "subject": "Review of an Incorrect Question", "body": "Review attached.",
+                  "attachment": render_review_doc(student, row, letter), "filename": "review.docx"}
+        with smtplib.SMTP(HOST, PORT) as server:
+            server.send_message(build_message("portal@example.org", record))
+
+
+def run_outbox(df, args):
+    db = LocalStorage()
+    for recipient, student, row, letter in completions(df, args.completions, args.recipients):
+        enqueue_email(db, [recipient], "Review of an Incorrect Question", "Review attached.",
+                      attachment=render_review_doc(student, row, letter), filename="review.docx")
+    pool = SMTPPool(settings())
+    drain_outbox(db, pool)
+    pool.close()
+
+
+def run_digest(df, args):
+    db = LocalStorage()
+    for recipient, student, row, letter in completions(df, args.completions, args.recipients):
+        enqueue_review_item(db, recipient, student, row, letter)
+    later = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+    flush_digests(db, datetime.timedelta(minutes=1), now=later)
+    pool = SMTPPool(settings())
+    drain_outbox(db, pool)
+    pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--completions", type=int, default=200)
+    parser.add_argument("--recipients", type=int, default=20)
+    args = parser.parse_args()
+
+    df, _ = synthetic_bank(1000)
+    handler = CountingHandler()
+    controller = Controller(handler, hostname=HOST, port=PORT)
+    controller.start()
+    try:
+        print(f"{args.completions} completions for {args.recipients} recipients")
+        print(f"{'mode':>8} {'seconds':>9} {'completions/s':>14} {'emails':>7} {'MiB sent':>9}")
+        for name, run in (("direct", run_direct), ("outbox", run_outbox), ("digest", run_digest)):
+            handler.messages = handler.bytes = 0
+            started = time.perf_counter()
+            run(df, args)
+            elapsed = time.perf_counter() - started
+            print(f"{name:>8} {elapsed:>9.2f} {args.completions / elapsed:>14.1f} "
+                  f"{handler.messages:>7} {handler.bytes / 2**20:>9.2f}")
+    finally:
+        controller.stop()
+
+
+if __name__ == "__main__":
+    main()
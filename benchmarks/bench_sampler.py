@@ -0,0 +1,69 @@
+"""
+Microbenchmark: drawing a 5-question exam from banks of 1k, 10k and 100k questions.
+
+    filter+sample  the old path: full_df[~isin(used)].sample(5)
+    sampler        question_sampler.sample_positions + bank.take (5 rows)
+
+Run from the repository root:
+    python benchmarks/bench_sampler.py [--used 200] [--repeat 200]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from question_bank import QuestionBank, encode_bank  # noqa: E402
+from question_sampler import sample_positions  # noqa: E402
+
+SIZES = (1_000, 10_000, 100_000)
+
+
+def synthetic_bank(n, seed=0):
+    rng = np.random.default_rng(seed)
+    filler = "A child presents with a long free-text vignette. " * 12
+    df = pd.DataFrame({
+        "record_id": [f"Q{i:07d}" for i in range(n)],
+        "question": [f"{filler}#{i}" for i in range(n)],
+        "anchor": "What is the most likely diagnosis?",
+        "answerchoice_a": "Option A", "answerchoice_b": "Option B", "answerchoice_c": "Option C",
+        "answerchoice_d": "Option D", "answerchoice_e": "Option E",
+        "correct_answer": "b",
+        "answer_explanation": filler,
+        "subject": rng.integers(1, 20, size=n).astype(str),
+    })
+    bank = QuestionBank(encode_bank(df, ()), source="csv", df=df)
+    return df, bank
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--used", type=int, default=200, help="recently used questions to exclude")
+    parser.add_argument("--repeat", type=int, default=200, help="draws per measurement")
+    args = parser.parse_args()
+
+    print(f"{'questions':>10} {'filter+sample':>15} {'sampler':>12} {'speedup':>8}")
+    for n in SIZES:
+        full_df, bank = synthetic_bank(n)
+        rng = np.random.default_rng(1)
+        used_ids = [f"Q{i:07d}" for i in rng.choice(n, size=min(args.used, n // 2), replace=False)]
+
+        def old_path():
+            available_df = full_df[~full_df["record_id"].isin(used_ids)]
+            return available_df.sample(n=5, replace=False)
+
+        def new_path():
+            positions = sample_positions(bank, 5, exclude=bank.positions(used_ids), rng=rng)
+            return bank.take(positions)
+
+        old = min(timeit.repeat(old_path, number=args.repeat, repeat=3)) / args.repeat
+        new = min(timeit.repeat(new_path, number=args.repeat, repeat=3)) / args.repeat
+        print(f"{n:>10} {old * 1e6:>12.1f} us {new * 1e6:>9.1f} us {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Headless load test: N simulated students log in, answer 5 questions and
+complete the exam, driven through streamlit's AppTest against the local
+SQLite storage backend (no Firebase project or SMTP server needed).
+
+Students run in --workers processes that share one SQLite file, so that many
+exams are in flight at once. Reported per app:
+    p50/p95/p99 latency of each step (login, answer, next, submit)
+    storage operations per exam (get/set/delete/query/commit)
+    peak RSS of the worker processes
+    deep size of each session-state key at completion (session_footprint)
+
+Run from the repository root:
+    python benchmarks/load_test.py --students 200 --workers 8 [--app shelf_app_student.py]
+"""
+import argparse
+import collections
+import datetime
+import multiprocessing
+import os
+import random
+import resource
+import smtplib
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from session_footprint import format_stats, key_sizes, summarize  # noqa: E402
+
+APPS = ("shelf_app.py", "shelf_app_student.py")
+STEPS = ("login", "answer", "next", "submit")
+
+
+class RecordingSMTP:
+    """
+    Stands in for smtplib.SMTP_SSL so completions never reach a real mail server.
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def login(self, *args):
+        pass
+
+    def send_message(self, *args, **kwargs):
+        pass
+
+    def noop(self):
+        return (250, b"OK")
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_secrets(app, students):
+    today = datetime.date.today().isoformat()
+    recipients = {}
+    for i in range(students):
+        email = f"student{i}@example.org"
+        recipients[f"load{i}"] = email if app == "shelf_app.py" else f"{email}|{today}"
+    return {
+        "recipients": recipients,
+        "general": {"email": "portal@example.org", "email_password": "unused"},
+    }
+
+
+def click(at, label):
+    for button in at.button:
+        if button.label == label and not button.disabled:
+            return button.click()
+    raise RuntimeError(f"No enabled button {label!r}")
+
+
+def timed_run(at, timings, step):
+    started = time.perf_counter()
+    at.run()
+    timings[step].append(time.perf_counter() - started)
+    if at.exception:
+        raise RuntimeError(f"{step}: {at.exception[0].message}")
+
+
+def run_student(app, secrets, index, timings, rng):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(os.path.join(REPO, app), default_timeout=60)
+    for section, values in secrets.items():
+        at.secrets[section] = values
+    at.run()
+
+    at.text_input[0].input(f"load{index}")
+    if app == "shelf_app.py":
+        at.text_input[1].input(f"Student {index}")
+    click(at, "Login")
+    timed_run(at, timings, "login")
+
+    while not any(header.value == "Exam Completed" for header in at.header):
+        options = [b for b in at.button if not b.disabled and not b.label.startswith("Question")]
+        rng.choice(options).click()
+        timed_run(at, timings, "answer")
+        if any(b.label == "Submit and End Exam" for b in at.button):
+            click(at, "Submit and End Exam")
+            timed_run(at, timings, "submit")
+        else:
+            # shelf_app.py has no submit button: the last "Next Question" completes the exam.
+            click(at, "Next Question")
+            timed_run(at, timings, "next")
+    return key_sizes(at.session_state)
+
+
+def worker(app, db_path, workdir, secrets, indices, seed):
+    import storage
+
+    os.chdir(workdir)
+    shared = storage.LocalStorage(db_path)
+    # Hand the app our instance so its storage calls can be counted.
+    storage.open_storage = lambda secrets=None: shared
+    smtplib.SMTP_SSL = RecordingSMTP
+
+    rng = random.Random(seed)
+    timings = collections.defaultdict(list)
+    session_sizes = []
+    failures = 0
+    for index in indices:
+        try:
+            session_sizes.append(run_student(app, secrets, index, timings, rng))
+        except Exception as e:
+            failures += 1
+            print(f"student {index}: {e}", file=sys.stderr)
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return dict(timings), dict(shared.op_counts), failures, peak_rss_kb, session_sizes
+
+
+def write_bank(workdir, questions):
+    from bench_sampler import synthetic_bank
+
+    df, _ = synthetic_bank(questions)
+    df.to_csv(os.path.join(workdir, "load_test_bank.csv"), index=False)
+
+
+def run_app(app, args):
+    with tempfile.TemporaryDirectory() as workdir:
+        write_bank(workdir, args.questions)
+        db_path = os.path.join(workdir, "load_test.db")
+        secrets = make_secrets(app, args.students)
+        slices = [list(range(w, args.students, args.workers)) for w in range(args.workers)]
+
+        started = time.perf_counter()
+        with multiprocessing.get_context("spawn").Pool(args.workers) as pool:
+            results = pool.starmap(worker, [
+                (app, db_path, workdir, secrets, indices, w) for w, indices in enumerate(slices)
+            ])
+        elapsed = time.perf_counter() - started
+
+    timings = collections.defaultdict(list)
+    ops = collections.Counter()
+    failures = 0
+    peak_rss_kb = 0
+    session_sizes = []
+    for worker_timings, worker_ops, worker_failures, worker_rss, worker_sizes in results:
+        for step, values in worker_timings.items():
+            timings[step].extend(values)
+        ops.update(worker_ops)
+        failures += worker_failures
+        peak_rss_kb = max(peak_rss_kb, worker_rss)
+        session_sizes.extend(worker_sizes)
+
+    completed = args.students - failures
+    print(f"\n{app}: {completed}/{args.students} exams in {elapsed:.1f}s "
+          f"({args.workers} workers, {args.questions} questions)")
+    print(f"{'step':>8} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for step in STEPS:
+        values = np.array(timings.get(step, [])) * 1000
+        if len(values):
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            print(f"{step:>8} {len(values):>7} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f}")
+    per_exam = {op: round(count / max(completed, 1), 2) for op, count in sorted(ops.items())}
+    print(f"storage ops per exam: {per_exam} (total {sum(ops.values()) / max(completed, 1):.1f})")
+    print(f"peak worker RSS: {peak_rss_kb / 1024:.0f} MiB")
+    if session_sizes:
+        mean_session = sum(sum(s.values()) for s in session_sizes) / len(session_sizes)
+        print(f"session state at completion: {mean_session / 1024:.1f} KiB per session")
+        print(format_stats(summarize(session_sizes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless login -> exam -> completion load test.")
+    parser.add_argument("--app", choices=APPS + ("both",), default="both")
+    parser.add_argument("--students", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4)
+    parser.add_argument("--questions", type=int, default=None,
+                        help="synthetic bank size (default: 10 per student, at least 2000)")
+    args = parser.parse_args()
+    args.workers = max(1, min(args.workers, args.students))
+    args.questions = args.questions or max(2000, 10 * args.students)
+
+    for app in (APPS if args.app == "both" else (args.app,)):
+        run_app(app, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Exam-session state shared by both apps.
+
+The exam lives in st.session_state and is mirrored to one "exam_sessions"
+document per passcode. Saves only stage the fields that changed since the
+last write; the staged changes are written as one merge per rerun (by
+rerun() or flush_exam_state()), or added to the batch of the user action
+that caused them. The exam's questions are kept as bank positions and
+persisted as record_ids.
+"""
+import streamlit as st
+
+from question_bank import get_question_bank
+from storage import SERVER_TIMESTAMP
+
+# Fields persisted in the "exam_sessions" document. Answer feedback is not
+# stored: it is rebuilt from the result codes and the question when rendered.
+EXAM_STATE_FIELDS = ("question_index", "score", "results", "selected_answers",
+                     "question_ids", "email_sent", "exam_complete", "completion_token")
+
+
+def get_user_key():
+    # Use the entire assigned passcode as the key.
+    return str(st.session_state.assigned_passcode)
+
+
+def write_doc(db, collection, doc_id, data, batch=None, merge=False):
+    """
+    Sets the document to data, or stages the write in batch so that all the
+    writes for one user action reach storage in a single atomic commit.
+    """
+    if batch is not None:
+        batch.set(collection, doc_id, data, merge=merge)
+    else:
+        db.set(collection, doc_id, data, merge=merge)
+
+
+def set_exam_questions(bank, positions):
+    """
+    Stores the exam's questions in the session as bank positions. Only the
+    record_ids are persisted; they are the stable reference.
+    """
+    st.session_state.question_positions = tuple(int(pos) for pos in positions)
+    st.session_state.bank_version = bank.fingerprint
+    st.session_state.question_ids = [bank.value("record_id", pos) for pos in st.session_state.question_positions]
+
+
+def exam_records():
+    """
+    The session's questions as the bank's shared QuestionRecords (None for a
+    question no longer in the bank). Positions are re-resolved from the
+    record_ids when the bank has been rebuilt since they were stored.
+    """
+    bank = get_question_bank()
+    if st.session_state.bank_version != bank.fingerprint:
+        st.session_state.question_positions = tuple(bank.position(rid) for rid in st.session_state.question_ids)
+        st.session_state.bank_version = bank.fingerprint
+    return [None if pos is None else bank.record(pos) for pos in st.session_state.question_positions]
+
+
+def current_exam_state():
+    state = {}
+    for field in EXAM_STATE_FIELDS:
+        value = st.session_state.get(field, False)
+        # Copy lists: they are updated in place, which would hide the change.
+        state[field] = list(value) if isinstance(value, list) else value
+    return state
+
+
+def mark_exam_state_saved():
+    """
+    Records the current exam fields as already stored (e.g. after resuming),
+    so the next save only writes what changes from here on.
+    """
+    st.session_state.saved_exam_state = current_exam_state()
+    st.session_state.pending_exam_state = {}
+
+
+def save_exam_state(db, batch=None):
+    """
+    Stages the exam fields that changed since the last write. Saves made during
+    one rerun are coalesced and written by flush_exam_state() before the next
+    rerun, or straight into batch when one is given.
+    """
+    saved = st.session_state.saved_exam_state
+    for field, value in current_exam_state().items():
+        if field not in saved or saved[field] != value:
+            st.session_state.pending_exam_state[field] = value
+        else:
+            st.session_state.pending_exam_state.pop(field, None)
+    if batch is not None:
+        flush_exam_state(db, batch)
+
+
+def flush_exam_state(db, batch=None):
+    """
+    Writes the staged changes as a single merge into the session document.
+    The first write of a new exam replaces the document instead.
+    """
+    pending = st.session_state.pending_exam_state
+    if not pending:
+        return
+    saved = st.session_state.saved_exam_state
+    data = dict(pending, timestamp=SERVER_TIMESTAMP)
+    write_doc(db, "exam_sessions", get_user_key(), data, batch, merge=bool(saved))
+    saved.update(pending)
+    st.session_state.pending_exam_state = {}
+
+
+def rerun(db):
+    """
+    Flushes any staged exam state, then reruns the script.
+    """
+    flush_exam_state(db)
+    st.rerun()
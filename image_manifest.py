@@ -0,0 +1,108 @@
+"""
+record_id -> image manifest for the question images.
+
+The images folder is scanned once and the result shared by every session;
+lookups are dictionary hits instead of a glob per extension on every render.
+The manifest is rebuilt when the folder's modification time changes, which
+happens whenever an image is added, removed or renamed (replace a file by
+writing a new one and renaming it over the old, as deploys do).
+
+Each entry records the image's path, pixel dimensions, size in bytes and
+modification time.
+"""
+import collections
+import os
+import threading
+
+from PIL import Image
+
+# Same precedence as the old per-extension glob: the first match wins.
+EXTENSIONS = ("jpg", "jpeg", "png", "gif")
+DEFAULT_FOLDER = "images"
+
+ImageInfo = collections.namedtuple("ImageInfo", ["record_id", "path", "width", "height", "size", "mtime_ns"])
+
+
+def _dimensions(path):
+    try:
+        # Only the header is read here; the pixels are never decoded.
+        with Image.open(path) as image:
+            return image.size
+    except (OSError, ValueError):
+        return None, None
+
+
+class ImageManifest:
+    def __init__(self, folder, mtime_ns, entries):
+        self.folder = folder
+        self.mtime_ns = mtime_ns
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, record_id):
+        """
+        Returns the ImageInfo for record_id, or None if it has no image.
+        """
+        return self.entries.get(str(record_id))
+
+    def path(self, record_id):
+        info = self.entries.get(str(record_id))
+        return info.path if info else None
+
+    def total_bytes(self):
+        return sum(info.size for info in self.entries.values())
+
+
+def _folder_mtime(folder):
+    try:
+        return os.stat(folder).st_mtime_ns
+    except OSError:
+        return None
+
+
+def scan_images(folder=DEFAULT_FOLDER):
+    """
+    Builds the manifest with one listing of folder.
+    """
+    mtime_ns = _folder_mtime(folder)
+    rank = {ext: i for i, ext in enumerate(EXTENSIONS)}
+    found = {}
+    if mtime_ns is not None:
+        with os.scandir(folder) as it:
+            for entry in it:
+                record_id, dot, ext = entry.name.rpartition(".")
+                if not dot or ext not in rank or not entry.is_file():
+                    continue
+                if record_id in found and found[record_id][0] <= rank[ext]:
+                    continue
+                found[record_id] = (rank[ext], entry)
+
+    entries = {}
+    for record_id, (_, entry) in found.items():
+        path = os.path.join(folder, entry.name)
+        width, height = _dimensions(path)
+        stat = entry.stat()
+        entries[record_id] = ImageInfo(record_id, path, width, height, stat.st_size, stat.st_mtime_ns)
+    return ImageManifest(folder, mtime_ns, entries)
+
+
+_manifests = {}
+_manifest_lock = threading.Lock()
+
+
+def get_image_manifest(folder=DEFAULT_FOLDER):
+    """
+    Returns the shared manifest for folder, rescanning it only when the
+    folder has changed since the last scan.
+    """
+    mtime_ns = _folder_mtime(folder)
+    manifest = _manifests.get(folder)
+    if manifest is not None and manifest.mtime_ns == mtime_ns:
+        return manifest
+    with _manifest_lock:
+        manifest = _manifests.get(folder)
+        if manifest is None or manifest.mtime_ns != _folder_mtime(folder):
+            manifest = _manifests[folder] = scan_images(folder)
+        return manifest
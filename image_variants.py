@@ -0,0 +1,123 @@
+"""
+Pre-sized, recompressed variants of the question images.
+
+    display   WebP, at most 1000 px wide, for st.image on the exam page
+    doc       JPEG, at most 600 px wide (4 inches at 150 dpi), for the review
+              documents (python-docx cannot embed WebP)
+
+Variants are written to .image_cache/ under the SHA-256 of the original's
+content, so an edited image gets new variants and unchanged ones are shared
+across deploys. They are made on first use, or ahead of time with
+    python image_variants.py [--folder images]
+When a variant would not be smaller than the original (already small
+images), or cannot be made, the original path is used instead.
+"""
+import argparse
+import hashlib
+import logging
+import os
+import threading
+
+from PIL import Image
+
+from image_manifest import DEFAULT_FOLDER, get_image_manifest
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = ".image_cache"
+VARIANTS = {
+    "display": {"max_width": 1000, "format": "WEBP", "ext": "webp", "options": {"quality": 80, "method": 4}},
+    "doc": {"max_width": 600, "format": "JPEG", "ext": "jpg", "options": {"quality": 82, "optimize": True}},
+}
+
+# (path, size, mtime_ns) -> content hash, so the original is hashed once.
+_hashes = {}
+# (content hash, variant) -> path to use (the variant or the original).
+_resolved = {}
+_lock = threading.Lock()
+
+
+def content_hash(info):
+    key = (info.path, info.size, info.mtime_ns)
+    digest = _hashes.get(key)
+    if digest is None:
+        with open(info.path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:32]
+        _hashes[key] = digest
+    return digest
+
+
+def _convert(image, spec):
+    if image.width > spec["max_width"]:
+        height = round(image.height * spec["max_width"] / image.width)
+        image = image.resize((spec["max_width"], height), Image.LANCZOS)
+    if spec["format"] == "JPEG" and image.mode != "RGB":
+        # JPEG has no alpha: flatten transparent images onto white.
+        rgba = image.convert("RGBA")
+        image = Image.new("RGB", rgba.size, "white")
+        image.paste(rgba, mask=rgba.getchannel("A"))
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+    return image
+
+
+def make_variant(info, variant, cache_dir=CACHE_DIR):
+    """
+    Returns the path of info's variant, creating it if needed, or the
+    original path when the variant would not be smaller.
+    """
+    spec = VARIANTS[variant]
+    digest = content_hash(info)
+    resolved = _resolved.get((digest, variant))
+    if resolved and os.path.exists(resolved):
+        return resolved
+
+    path = os.path.join(cache_dir, f"{digest}_{variant}.{spec['ext']}")
+    with _lock:
+        if not os.path.exists(path):
+            with Image.open(info.path) as image:
+                if getattr(image, "is_animated", False):
+                    # Keep animated GIFs as they are.
+                    _resolved[(digest, variant)] = info.path
+                    return info.path
+                image = _convert(image, spec)
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                image.save(tmp_path, spec["format"], **spec["options"])
+            os.replace(tmp_path, path)
+    resolved = path if os.path.getsize(path) < info.size else info.path
+    _resolved[(digest, variant)] = resolved
+    return resolved
+
+
+def get_image_variant(record_id, variant, folder=DEFAULT_FOLDER):
+    """
+    Returns the path to show (variant "display") or embed (variant "doc")
+    for record_id's image, or None if it has no image.
+    """
+    info = get_image_manifest(folder).get(record_id)
+    if info is None:
+        return None
+    try:
+        return make_variant(info, variant)
+    except (OSError, ValueError):
+        logger.warning("Image variant %s for %s failed", variant, record_id, exc_info=True)
+        return info.path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the question image variants.")
+    parser.add_argument("--folder", default=DEFAULT_FOLDER)
+    args = parser.parse_args()
+
+    manifest = get_image_manifest(args.folder)
+    total = {variant: 0 for variant in VARIANTS}
+    for info in manifest.entries.values():
+        for variant in VARIANTS:
+            total[variant] += os.path.getsize(make_variant(info, variant))
+    print(f"{len(manifest)} images, {manifest.total_bytes() / 1024:.0f} KiB originals; "
+          + ", ".join(f"{variant} {size / 1024:.0f} KiB" for variant, size in total.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Maintenance jobs for the exam data.
+
+Run from the app directory so st.secrets finds .streamlit/secrets.toml
+(SHELF_STORAGE selects a local backend, as for the apps):
+    python maintenance.py backfill-recommendation-keys
+    python maintenance.py drain-outbox
+    python maintenance.py migrate-passcode-status
+    python maintenance.py migrate-used-questions
+    python maintenance.py sweep
+"""
+import argparse
+import datetime
+
+import streamlit as st
+
+from outbox import SMTPPool, drain_outbox, smtp_settings
+from passcode_status import migrate_passcode_status
+from recommendations import backfill_recommendation_keys
+from review_digest import digest_window, flush_digests
+from storage import open_storage
+from sweeper import sweep_expired
+
+# Firestore allows at most 500 writes per batch.
+BATCH_SIZE = 400
+# How long a question stays used for a student (see get_global_used_questions()).
+USED_QUESTION_DAYS = 7
+
+
+def migrate_used_questions(db, now=None):
+    """
+    Folds the student app's legacy per-question "global_used_questions"
+    documents from the last USED_QUESTION_DAYS into each user's
+    used_questions/{user} map, keeping the latest timestamp per question,
+    so students are not given recent questions again after the switch.
+    Returns the number of user documents written.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    cutoff = now - datetime.timedelta(days=USED_QUESTION_DAYS)
+    by_user = {}
+    for _, data in db.query("global_used_questions", [("timestamp", ">=", cutoff)]):
+        # The preceptor app's documents in this collection have no user.
+        if data.get("user") and data.get("record_id") is not None:
+            used = by_user.setdefault(data["user"], {})
+            record_id = str(data["record_id"])
+            used[record_id] = max(used.get(record_id, data["timestamp"]), data["timestamp"])
+
+    written = 0
+    batch = db.batch()
+    for user, legacy in by_user.items():
+        current = (db.get("used_questions", user) or {}).get("used", {})
+        updates = {record_id: ts for record_id, ts in legacy.items()
+                   if current.get(record_id) is None or current[record_id] < ts}
+        if updates:
+            batch.set("used_questions", user, {"user": user, "used": updates}, merge=True)
+            written += 1
+            if len(batch) >= BATCH_SIZE:
+                batch.commit()
+                batch = db.batch()
+    if len(batch):
+        batch.commit()
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance jobs for the exam data.")
+    parser.add_argument("job", choices=["backfill-recommendation-keys", "drain-outbox", "migrate-passcode-status",
+                                        "migrate-used-questions", "sweep"])
+    args = parser.parse_args()
+
+    db = open_storage(st.secrets)
+    if args.job == "backfill-recommendation-keys":
+        print(f"Updated {backfill_recommendation_keys(db)} recommendation documents.")
+    elif args.job == "drain-outbox":
+        window = digest_window(st.secrets)
+        if window:
+            print(f"Queued {flush_digests(db, window)} digest emails.")
+        pool = SMTPPool(smtp_settings(st.secrets))
+        try:
+            sent, failed = drain_outbox(db, pool)
+        finally:
+            pool.close()
+        print(f"Sent {sent} queued emails; {failed} failed.")
+    elif args.job == "migrate-passcode-status":
+        print(f"Wrote {migrate_passcode_status(db)} passcode status documents.")
+    elif args.job == "migrate-used-questions":
+        print(f"Wrote {migrate_used_questions(db)} used-question documents.")
+    elif args.job == "sweep":
+        counts = sweep_expired(db)
+        print(f"Deleted {sum(counts.values())} expired documents: {dict(counts)}")
+        print(f"Updated {backfill_recommendation_keys(db)} recommendation documents.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""
+Persistent outbox for the review emails.
+
+Completing an exam only writes a message record to the "email_outbox"
+collection (inside the completion batch, so it is stored atomically with the
+result). A background worker thread sends pending messages through one
+reused SMTP connection and retries failures with exponential backoff, so the
+completion page never waits on the mail server.
+
+SMTP settings come from st.secrets["smtp"] (all optional):
+    host, port      default smtp.gmail.com:465
+    ssl             implicit TLS (default true); set false for a plain server
+    starttls        upgrade a plain connection with STARTTLS (default false)
+    username        default general.email; empty to skip login
+    password        default general.email_password
+so the worker can be pointed at a local stand-in such as
+    python -m aiosmtpd -n -l localhost:8025
+with host = "localhost", port = 8025, ssl = false, username = "".
+
+Delivery is at least once: a message is marked sent only after the server
+accepts it. Before sending, a worker claims the message in a transaction
+for CLAIM_SECONDS, so the app workers of several server processes and
+`python maintenance.py drain-outbox` can run together without sending a
+message twice. A message is sent again only if its worker dies (or its
+send outlasts the claim) before it is marked sent.
+"""
+import datetime
+import logging
+import smtplib
+import threading
+import time
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email import encoders
+
+from storage import SERVER_TIMESTAMP, DELETE_FIELD, new_doc_id
+from tracing import message_size, trace_phase, tracer
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = "email_outbox"
+MAX_ATTEMPTS = 6
+BACKOFF_SECONDS = 30
+MAX_BACKOFF_SECONDS = 3600
+POLL_SECONDS = 15
+# Connections idle for longer than this are probed with NOOP before reuse.
+IDLE_CHECK_SECONDS = 60
+# How long a claimed message is reserved for the worker sending it.
+CLAIM_SECONDS = 300
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def enqueue_email(db, to_emails, subject, body, attachment=None, filename=None, batch=None):
+    """
+    Stores a pending message and returns its id. attachment is the raw file
+    content (bytes); pass batch to commit the message with other writes.
+    """
+    message_id = new_doc_id()
+    data = {
+        "to": list(to_emails),
+        "subject": subject,
+        "body": body,
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": _now(),
+        "created_at": SERVER_TIMESTAMP,
+    }
+    if attachment is not None:
+        data["attachment"] = bytes(attachment)
+        data["filename"] = filename or "attachment"
+    if batch is not None:
+        batch.set(COLLECTION, message_id, data)
+    else:
+        db.set(COLLECTION, message_id, data)
+    return message_id
+
+
+def smtp_settings(secrets):
+    smtp = dict(secrets["smtp"]) if "smtp" in secrets else {}
+    general = secrets["general"]
+    return {
+        "host": smtp.get("host", "smtp.gmail.com"),
+        "port": int(smtp.get("port", 465)),
+        "ssl": bool(smtp.get("ssl", True)),
+        "starttls": bool(smtp.get("starttls", False)),
+        "username": smtp.get("username", general["email"]),
+        "password": smtp.get("password", general.get("email_password", "")),
+        "from_email": smtp.get("from_email", general["email"]),
+    }
+
+
+def build_message(from_email, record):
+    msg = MIMEMultipart()
+    msg["From"] = from_email
+    msg["To"] = ", ".join(record["to"])
+    msg["Subject"] = record["subject"]
+    msg.attach(MIMEText(record["body"], "html"))
+    if record.get("attachment") is not None:
+        part = MIMEBase("application", "octet-stream")
+        part.set_payload(record["attachment"])
+        encoders.encode_base64(part)
+        part.add_header("Content-Disposition", "attachment", filename=record["filename"])
+        msg.attach(part)
+    return msg
+
+
+class SMTPPool:
+    """
+    Keeps one logged-in SMTP connection open and reuses it for every send,
+    reconnecting when the server has dropped it.
+    """
+
+    def __init__(self, settings, timeout=30):
+        self.settings = settings
+        self.timeout = timeout
+        self._server = None
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        with tracer.span("smtp.connect", self.settings["host"]):
+            return self._open()
+
+    def _open(self):
+        s = self.settings
+        if s["ssl"]:
+            server = smtplib.SMTP_SSL(s["host"], s["port"], timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(s["host"], s["port"], timeout=self.timeout)
+            if s["starttls"]:
+                server.starttls()
+        if s["username"]:
+            server.login(s["username"], s["password"])
+        return server
+
+    def _alive(self):
+        if time.monotonic() - self._last_used < IDLE_CHECK_SECONDS:
+            return True
+        try:
+            with tracer.span("smtp.noop", self.settings["host"]):
+                return self._server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def send(self, msg, to_addrs):
+        with self._lock:
+            if self._server is not None and not self._alive():
+                self._close()
+            for retry in (True, False):
+                if self._server is None:
+                    self._server = self._connect()
+                try:
+                    with tracer.span("smtp.send", self.settings["host"], message_size(msg)):
+                        self._server.send_message(msg, from_addr=self.settings["from_email"], to_addrs=to_addrs)
+                    self._last_used = time.monotonic()
+                    return
+                except smtplib.SMTPServerDisconnected:
+                    self._close()
+                    if not retry:
+                        raise
+
+    def _close(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except Exception:
+            self._server.close()
+        self._server = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+def backoff(attempts):
+    return min(BACKOFF_SECONDS * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS)
+
+
+def _claimable(record, now):
+    if record is None or record.get("status") != "pending":
+        return False
+    if record.get("next_attempt_at") and record["next_attempt_at"] > now:
+        return False
+    return not (record.get("claimed_until") and record["claimed_until"] > now)
+
+
+def claim_message(db, message_id, now=None):
+    """
+    Reserves a due, pending message for this caller for CLAIM_SECONDS.
+    Returns the message record, or None if it is not due or another worker
+    holds it.
+    """
+    now = now or _now()
+    token = new_doc_id()
+
+    def claim(record):
+        if not _claimable(record, now):
+            return None
+        return {"claimed_by": token, "claimed_until": now + datetime.timedelta(seconds=CLAIM_SECONDS)}
+
+    record = db.transform(COLLECTION, message_id, claim)
+    if record is None or record.get("claimed_by") != token:
+        return None
+    return record
+
+
+def drain_outbox(db, pool, now=None):
+    """
+    Sends every pending message that is due, claiming each one first.
+    Failed sends are rescheduled with exponential backoff and given up
+    ("failed") after MAX_ATTEMPTS. Returns (sent, failed) counts for this pass.
+    """
+    now = now or _now()
+    sent = failed = 0
+    # Due time is checked here rather than in the query, which keeps the
+    # query on a single field (no composite Firestore index needed).
+    for message_id, record in db.query(COLLECTION, [("status", "==", "pending")]):
+        if not _claimable(record, now):
+            continue
+        record = claim_message(db, message_id, now)
+        if record is None:
+            continue
+        try:
+            pool.send(build_message(pool.settings["from_email"], record), record["to"])
+        except Exception as e:
+            attempts = record.get("attempts", 0) + 1
+            update = {"attempts": attempts, "last_error": str(e),
+                      "claimed_by": DELETE_FIELD, "claimed_until": DELETE_FIELD}
+            if attempts >= MAX_ATTEMPTS:
+                update["status"] = "failed"
+            else:
+                update["next_attempt_at"] = _now() + datetime.timedelta(seconds=backoff(attempts))
+            db.set(COLLECTION, message_id, update, merge=True)
+            failed += 1
+            continue
+        # The attachment is no longer needed once the message is delivered.
+        db.set(COLLECTION, message_id, {
+            "status": "sent",
+            "sent_at": SERVER_TIMESTAMP,
+            "attachment": DELETE_FIELD,
+            "claimed_by": DELETE_FIELD,
+            "claimed_until": DELETE_FIELD,
+        }, merge=True)
+        sent += 1
+    return sent, failed
+
+
+class OutboxWorker(threading.Thread):
+    """
+    Daemon thread that drains the outbox every POLL_SECONDS, or as soon as
+    wake() is called after a message has been committed. jobs are callables
+    run with db before each pass, e.g. to queue due digest emails; a failing
+    job is logged and does not hold up the drain.
+    """
+
+    def __init__(self, db, pool, poll_seconds=POLL_SECONDS, jobs=()):
+        super().__init__(name="email-outbox", daemon=True)
+        self.db = db
+        self.pool = pool
+        self.jobs = list(jobs)
+        self.poll_seconds = poll_seconds
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+
+    def run(self):
+        while not self._stopping.is_set():
+            self._wake.clear()
+            with trace_phase("outbox"):
+                for job in self.jobs:
+                    try:
+                        job(self.db)
+                    except Exception:
+                        logger.exception("email outbox: job %r failed", job)
+                try:
+                    drain_outbox(self.db, self.pool)
+                except Exception:
+                    logger.exception("email outbox: drain failed")
+            self._wake.wait(self.poll_seconds)
+        self.pool.close()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def start_outbox_worker(db, secrets, jobs=()):
+    """
+    Starts the process-wide outbox worker on first call and returns it.
+    """
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = OutboxWorker(db, SMTPPool(smtp_settings(secrets)), jobs=jobs)
+            _worker.start()
+        return _worker
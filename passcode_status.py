@@ -0,0 +1,146 @@
+"""
+Per-passcode status: when the passcode was first used and when it was last
+locked, in one "passcode_status" document per passcode.
+
+This replaces the separate "passcode_starts" and "locked_passcodes"
+collections: a login reads one document (recording the start time in the
+same transaction on first use, so concurrent first logins agree on it), and
+the result is kept in a process-wide cache for CACHE_SECONDS, so the
+completion page and repeat logins do not read it again. Locks written by
+this process update the cache once committed; callers that must see locks
+set by other processes pass fresh=True.
+
+Run `python maintenance.py migrate-passcode-status` once, before deploying,
+to copy the existing start and lock times into the new collection.
+"""
+import collections
+import datetime
+import threading
+import time
+
+from storage import SERVER_TIMESTAMP
+
+COLLECTION = "passcode_status"
+LEGACY_STARTS = "passcode_starts"
+LEGACY_LOCKS = "locked_passcodes"
+CACHE_SECONDS = 60
+
+PasscodeStatus = collections.namedtuple("PasscodeStatus", ["start_time", "lock_time"])
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _status(data):
+    data = data or {}
+    return PasscodeStatus(data.get("start_time"), data.get("lock_time"))
+
+
+def _cached(passcode):
+    with _lock:
+        entry = _cache.get(passcode)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+
+def _remember(passcode, status):
+    with _lock:
+        _cache[passcode] = (time.monotonic() + CACHE_SECONDS, status)
+    return status
+
+
+def _start_if_missing(data):
+    if data and data.get("start_time"):
+        return None
+    return {"start_time": _now()}
+
+
+def get_passcode_status(db, passcode, start=False, fresh=False):
+    """
+    Returns the PasscodeStatus for passcode. With start=True a missing start
+    time is recorded as now, in the same transaction as the read.
+    """
+    passcode = str(passcode)
+    status = None if fresh else _cached(passcode)
+    if status is None or (start and status.start_time is None):
+        if start:
+            data = db.transform(COLLECTION, passcode, _start_if_missing)
+        else:
+            data = db.get(COLLECTION, passcode)
+        status = _remember(passcode, _status(data))
+    return status
+
+
+def is_locked(status, lock_hours, now=None):
+    """
+    True if the passcode was locked within the last lock_hours.
+    """
+    if status.lock_time is None:
+        return False
+    now = now or _now()
+    return (now - status.lock_time).total_seconds() < lock_hours * 3600
+
+
+def lock_passcode(db, passcode, batch=None):
+    """
+    Writes the lock time (the server timestamp). Call remember_lock() once
+    the write is committed.
+    """
+    data = {"lock_time": SERVER_TIMESTAMP}
+    if batch is not None:
+        batch.set(COLLECTION, str(passcode), data, merge=True)
+    else:
+        db.set(COLLECTION, str(passcode), data, merge=True)
+        remember_lock(passcode)
+
+
+def remember_lock(passcode, lock_time=None):
+    """
+    Records a committed lock in the cache.
+    """
+    passcode = str(passcode)
+    status = _cached(passcode) or PasscodeStatus(None, None)
+    _remember(passcode, status._replace(lock_time=lock_time or _now()))
+
+
+def clear_cache():
+    with _lock:
+        _cache.clear()
+
+
+def migrate_passcode_status(db, batch_size=400):
+    """
+    Copies start and lock times from the legacy collections into
+    passcode_status, keeping the earliest start and the latest lock.
+    Returns the number of documents written.
+    """
+    merged = {}
+    for collection, field in ((LEGACY_STARTS, "start_time"), (LEGACY_LOCKS, "lock_time")):
+        for passcode, data in db.query(collection):
+            if data.get(field) is not None:
+                merged.setdefault(passcode, {})[field] = data[field]
+    existing = dict(db.query(COLLECTION))
+    written = 0
+    batch = db.batch()
+    for passcode, legacy in merged.items():
+        current = existing.get(passcode, {})
+        updates = {}
+        for field, pick in (("start_time", min), ("lock_time", max)):
+            if field in legacy:
+                value = legacy[field] if current.get(field) is None else pick(legacy[field], current[field])
+                if value != current.get(field):
+                    updates[field] = value
+        if updates:
+            batch.set(COLLECTION, passcode, updates, merge=True)
+            written += 1
+            if len(batch) >= batch_size:
+                batch.commit()
+                batch = db.batch()
+    if len(batch):
+        batch.commit()
+    return written
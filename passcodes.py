@@ -0,0 +1,161 @@
+"""
+Passcode registry compiled from st.secrets["recipients"].
+
+Each entry maps a passcode to its recipient:
+    shelf_app.py            passcode = "preceptor@example.org"
+    shelf_app_student.py    passcode = "student@example.org|2025-04-07"
+where the date is the start of the student's rotation (the passcode
+expires ROTATION_DAYS later). The part of the passcode after its last "_",
+if any, is its subject designation. Designations are routed to a bank
+subject by st.secrets["subject_routes"], which extends or overrides
+DEFAULT_SUBJECT_ROUTES:
+    [subject_routes]
+    aaa = "Respiratory"
+    aac = "7"
+A passcode with a routed designation draws its exams from that subject's
+partition of the question bank.
+
+The table is parsed once into a read-only registry, so login validation is
+a dictionary lookup. Malformed entries are logged as warnings when the
+registry is built and reported again if their passcode is used.
+"""
+import collections
+import datetime
+import functools
+import logging
+import threading
+import types
+
+from dateutil import tz
+
+logger = logging.getLogger(__name__)
+
+ROTATION_DAYS = 25
+DEFAULT_SUBJECT_ROUTES = {
+    "aaa": "Respiratory",
+    "aab": "School-Based",
+}
+LOCAL_TZ = tz.gettz("America/New_York")
+
+
+class Recipient(collections.namedtuple(
+        "Recipient", ["passcode", "email", "rotation_start", "expires_at", "designation", "subject"])):
+    """
+    One registry entry. rotation_start and expires_at (UTC) are None for
+    passcodes without a rotation date, subject is None for passcodes whose
+    designation is not routed.
+    """
+    __slots__ = ()
+
+    def expired(self, now=None):
+        if self.expires_at is None:
+            return False
+        return (now or datetime.datetime.now(datetime.timezone.utc)) > self.expires_at
+
+
+def subject_routes(secrets):
+    """
+    Designation -> subject table: the defaults plus st.secrets["subject_routes"].
+    """
+    routes = dict(DEFAULT_SUBJECT_ROUTES)
+    if "subject_routes" in secrets:
+        routes.update((str(designation), str(subject)) for designation, subject in secrets["subject_routes"].items())
+    return routes
+
+
+def parse_recipient(passcode, value, routes=DEFAULT_SUBJECT_ROUTES):
+    """
+    Parses one [recipients] entry; raises ValueError if it is malformed.
+    """
+    passcode = str(passcode)
+    parts = str(value).split("|")
+    if len(parts) > 2:
+        raise ValueError(f"expected 'email' or 'email|YYYY-MM-DD', got {value!r}")
+    email = parts[0].strip()
+    if not email:
+        raise ValueError("missing email address")
+    rotation_start = expires_at = None
+    if len(parts) == 2:
+        rotation_start = datetime.datetime.strptime(parts[1].strip(), "%Y-%m-%d").date()
+        # The end of the rotation is taken in the server's local time, as before.
+        expires_local = datetime.datetime.combine(rotation_start, datetime.time()) + datetime.timedelta(days=ROTATION_DAYS)
+        expires_at = expires_local.astimezone(datetime.timezone.utc)
+    designation = passcode.split("_")[-1] if "_" in passcode else None
+    return Recipient(passcode, email, rotation_start, expires_at, designation, routes.get(designation))
+
+
+class PasscodeRegistry:
+    def __init__(self, entries, errors):
+        self.entries = types.MappingProxyType(entries)
+        self.errors = types.MappingProxyType(errors)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, passcode):
+        """
+        Returns the Recipient for passcode, or None if it is unknown or
+        malformed (see error()).
+        """
+        return self.entries.get(passcode)
+
+    def error(self, passcode):
+        return self.errors.get(passcode)
+
+
+def build_registry(recipients, routes=DEFAULT_SUBJECT_ROUTES):
+    entries = {}
+    errors = {}
+    for passcode, value in recipients.items():
+        try:
+            entries[str(passcode)] = parse_recipient(passcode, value, routes)
+        except ValueError as e:
+            errors[str(passcode)] = str(e)
+    for passcode, error in errors.items():
+        logger.warning("recipients: malformed entry for passcode %r: %s", passcode, error)
+    return PasscodeRegistry(entries, errors)
+
+
+_registry = (None, None)
+_registry_lock = threading.Lock()
+
+
+def _forget_registry(*args, **kwargs):
+    global _registry
+    with _registry_lock:
+        _registry = (None, None)
+
+
+def get_passcode_registry(secrets):
+    """
+    Returns the registry for secrets["recipients"] (and the subject routes),
+    built on first use and again after the secrets file changes.
+    """
+    global _registry
+    with _registry_lock:
+        if _registry[0] is not secrets:
+            _registry = (secrets, build_registry(secrets["recipients"], subject_routes(secrets)))
+            # st.secrets signals when secrets.toml is edited and reloaded.
+            listener = getattr(secrets, "file_change_listener", None)
+            if listener is not None:
+                listener.connect(_forget_registry, weak=False)
+        return _registry[1]
+
+
+@functools.lru_cache(maxsize=4096)
+def passcode_expires_at(start_utc):
+    """
+    Expires on the same week's Friday at 23:59:59 local time (America/New_York).
+    Converts the UTC timestamp into local, finds that Friday date,
+    sets 23:59:59 local, then returns an equivalent UTC datetime.
+    """
+    start_local = start_utc.astimezone(LOCAL_TZ)
+    base = start_local.date()
+    # That week's Friday (weekday 4); Saturday and Sunday roll to the next one.
+    days_to_fri = (4 - base.weekday()) % 7
+    expiry_local = datetime.datetime.combine(
+        base + datetime.timedelta(days=days_to_fri),
+        datetime.time(hour=23, minute=59, second=59),
+        tzinfo=LOCAL_TZ,
+    )
+    return expiry_local.astimezone(datetime.timezone.utc)
@@ -0,0 +1,90 @@
+"""
+Display images for the exam page, with lookahead prefetching.
+
+The display variant of each question's image is read once into a
+process-wide LRU cache shared by all sessions. While a student reads
+question i, prefetch_question() warms question i + 1 on a background
+thread (making the image variant if needed and reading it into memory), so
+"Next Question" renders from memory. The option list needs no warming: it
+is part of the bank's QuestionRecord.
+"""
+import collections
+import concurrent.futures
+import threading
+
+from image_variants import get_image_variant
+
+MAX_CACHED_QUESTIONS = 256
+
+QuestionAssets = collections.namedtuple("QuestionAssets", ["record", "image"])
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="prefetch")
+# Keyed by the QuestionRecord itself: a reloaded bank compiles new records,
+# so stale entries are never hit and age out of the LRU.
+_cache = collections.OrderedDict()
+_pending = {}
+_lock = threading.Lock()
+
+
+def build_question_assets(record):
+    image = None
+    image_path = get_image_variant(record.record_id, "display")
+    if image_path:
+        with open(image_path, "rb") as f:
+            image = f.read()
+    return QuestionAssets(record, image)
+
+
+def _store(record, assets):
+    with _lock:
+        _cache[record] = assets
+        _cache.move_to_end(record)
+        while len(_cache) > MAX_CACHED_QUESTIONS:
+            _cache.popitem(last=False)
+        _pending.pop(record, None)
+
+
+def question_assets(record):
+    """
+    Returns the QuestionAssets for record, from the cache, from an in-flight
+    prefetch, or built now.
+    """
+    with _lock:
+        assets = _cache.get(record)
+        if assets is not None:
+            _cache.move_to_end(record)
+            return assets
+        future = _pending.get(record)
+    if future is not None:
+        try:
+            return future.result()
+        except Exception:
+            pass  # Build it here instead, raising the error in the session.
+    assets = build_question_assets(record)
+    _store(record, assets)
+    return assets
+
+
+def _prefetch(record):
+    assets = build_question_assets(record)
+    _store(record, assets)
+    return assets
+
+
+def prefetch_question(record):
+    """
+    Starts loading record's image in the background unless it is cached or
+    already being loaded.
+    """
+    with _lock:
+        if record in _cache or record in _pending:
+            return
+        future = _pending[record] = _executor.submit(_prefetch, record)
+    future.add_done_callback(lambda future: _prefetch_done(record, future))
+
+
+def _prefetch_done(record, future):
+    # A failed prefetch is forgotten so the next request builds it again.
+    if future.exception() is not None:
+        with _lock:
+            _pending.pop(record, None)
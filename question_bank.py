@@ -0,0 +1,430 @@
+"""
+Process-wide question bank.
+
+The bank is built once per server process and shared by every Streamlit
+session. It is only rebuilt when one of the CSV files changes (mtime or size),
+so a login no longer re-parses the exports.
+
+The REDCap CSV exports can also be compiled ahead of time into a columnar
+binary file (see `compile_bank` / `python question_bank.py`). Every column is
+stored as offsets into one shared UTF-8 text blob, next to a hashed record_id
+index. The app memory-maps that file, so a cold start only parses a small
+JSON header and all server processes share one page-cache copy.
+
+File layout (all integers little-endian, sections 8-byte aligned):
+    magic     8 bytes  b"SHELFQB1"
+    hlen      uint64   length of the JSON header that follows
+    header    JSON     rows, columns, source fingerprint, section table
+    offsets   uint64   (columns, rows + 1) start offsets into text
+    nulls     uint8    (columns, rows) 1 where the CSV cell was empty
+    index     int32    open-addressed record_id -> row table, -1 is empty
+    subject_offsets    uint32  (subjects + 1) slices into subject_positions
+    subject_positions  int32   row positions grouped by subject
+    text      bytes    UTF-8 cell values, column after column
+"""
+import argparse
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"SHELFQB1"
+FORMAT_VERSION = 2
+DEFAULT_COMPILED_PATH = "question_bank.bin"
+
+
+ANSWER_LETTERS = ("a", "b", "c", "d", "e")
+
+
+class QuestionRecord:
+    """
+    One question compiled for rendering: the cleaned answer options with
+    their letters, and the correct letter. Built straight from the bank
+    buffer, so the exam page never touches a pandas row.
+    """
+
+    __slots__ = ("position", "record_id", "question", "anchor", "explanation", "subject",
+                 "letters", "options", "correct_letter")
+
+    def __init__(self, bank, pos):
+        self.position = pos
+        self.record_id = bank.value("record_id", pos)
+        self.question = bank.optional_value("question", pos) or ""
+        self.anchor = bank.optional_value("anchor", pos) or ""
+        self.explanation = bank.optional_value("answer_explanation", pos) or ""
+        self.subject = bank.optional_value("subject", pos)
+        letters = []
+        options = []
+        for letter in ANSWER_LETTERS:
+            text = (bank.optional_value("answerchoice_" + letter, pos) or "").strip()
+            if text:
+                letters.append(letter)
+                options.append(text)
+        self.letters = tuple(letters)
+        self.options = tuple(options)
+        self.correct_letter = (bank.optional_value("correct_answer", pos) or "").strip().lower()
+
+    def answer_text(self, letter):
+        """
+        Cleaned text of the option for letter, or "" if there is none.
+        """
+        for option_letter, text in zip(self.letters, self.options):
+            if option_letter == letter:
+                return text
+        return ""
+
+
+class QuestionBank:
+    """
+    Immutable view over a compiled bank buffer (bytes or mmap).
+    Callers must treat `df` as read-only; filtering/sampling returns copies.
+    """
+
+    def __init__(self, buffer, source="compiled", build_seconds=0.0, df=None):
+        if bytes(buffer[:8]) != MAGIC:
+            raise ValueError("Not a compiled question bank.")
+        (header_len,) = struct.unpack_from("<Q", buffer, 8)
+        header = json.loads(bytes(buffer[16:16 + header_len]))
+        if header.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported question bank version {header.get('version')}.")
+
+        self._buffer = buffer
+        self.source = source
+        self.build_seconds = build_seconds
+        self.rows = header["rows"]
+        self.columns = header["columns"]
+        self.fingerprint = tuple(tuple(entry) for entry in header["sources"])
+        self._column_pos = {name: i for i, name in enumerate(self.columns)}
+
+        sections = header["sections"]
+        n_cols = len(self.columns)
+        self._offsets = self._section(sections["offsets"], "<u8").reshape(n_cols, self.rows + 1)
+        self._nulls = self._section(sections["nulls"], "u1").reshape(n_cols, self.rows)
+        self._index = self._section(sections["index"], "<i4")
+        self._index_mask = len(self._index) - 1
+        self._text_start = sections["text"][0]
+
+        subject_offsets = self._section(sections["subject_offsets"], "<u4")
+        subject_positions = self._section(sections["subject_positions"], "<i4")
+        self._subjects = {
+            subject: subject_positions[subject_offsets[i]:subject_offsets[i + 1]]
+            for i, subject in enumerate(header["subjects"])
+        }
+
+        self._df = df
+        self._df_lock = threading.Lock()
+        self._records = [None] * self.rows
+
+    def _section(self, section, dtype):
+        offset, nbytes = section
+        return np.frombuffer(self._buffer, dtype=dtype, count=nbytes // np.dtype(dtype).itemsize, offset=offset)
+
+    def __len__(self):
+        return self.rows
+
+    def value(self, column, pos):
+        """
+        Decodes a single cell. Returns None for cells that were empty in the CSV.
+        """
+        c = self._column_pos[column]
+        if self._nulls[c, pos]:
+            return None
+        start = self._text_start + int(self._offsets[c, pos])
+        end = self._text_start + int(self._offsets[c, pos + 1])
+        return bytes(self._buffer[start:end]).decode("utf-8")
+
+    def optional_value(self, column, pos):
+        """
+        Like value(), but None when the bank has no such column.
+        """
+        return self.value(column, pos) if column in self._column_pos else None
+
+    def record(self, pos):
+        """
+        The QuestionRecord for row pos, compiled on first use and then shared.
+        """
+        pos = int(pos)
+        record = self._records[pos]
+        if record is None:
+            # Two sessions may compile the same row at once; either copy is fine.
+            record = self._records[pos] = QuestionRecord(self, pos)
+        return record
+
+    def row(self, pos):
+        """
+        Row pos as a plain {column: value} dict (None for empty cells).
+        """
+        return {column: self.value(column, int(pos)) for column in self.columns}
+
+    def _cell(self, column, pos):
+        # DataFrame cells use NaN for missing values, as read_csv does.
+        value = self.value(column, pos)
+        return np.nan if value is None else value
+
+    def position(self, record_id):
+        """
+        Row position of record_id via the hashed index, or None if absent.
+        """
+        key = str(record_id)
+        slot = zlib.crc32(key.encode("utf-8")) & self._index_mask
+        while True:
+            pos = int(self._index[slot])
+            if pos < 0:
+                return None
+            if self.value("record_id", pos) == key:
+                return pos
+            slot = (slot + 1) & self._index_mask
+
+    def positions(self, record_ids):
+        """
+        Row positions for record_ids in the given order, skipping unknown ids.
+        """
+        positions = []
+        for record_id in record_ids:
+            pos = self.position(record_id)
+            if pos is not None:
+                positions.append(pos)
+        return positions
+
+    @property
+    def subjects(self):
+        return list(self._subjects)
+
+    def subject_positions(self, subject):
+        """
+        Read-only array of the row positions tagged with subject (empty if none).
+        """
+        return self._subjects.get(str(subject), np.empty(0, dtype="<i4"))
+
+    def take(self, positions):
+        """
+        DataFrame of just the rows at positions, in order. Costs O(len(positions)).
+        """
+        positions = [int(pos) for pos in positions]
+        return pd.DataFrame(
+            {column: [self._cell(column, pos) for pos in positions] for column in self.columns},
+            columns=self.columns,
+        )
+
+    @property
+    def df(self):
+        """
+        The whole bank as a DataFrame, decoded on first use and then shared.
+        """
+        if self._df is None:
+            with self._df_lock:
+                if self._df is None:
+                    self._df = pd.DataFrame({
+                        column: [self._cell(column, pos) for pos in range(self.rows)]
+                        for column in self.columns
+                    })
+        return self._df
+
+    @property
+    def nbytes(self):
+        nbytes = len(self._buffer)
+        if self._df is not None:
+            nbytes += int(self._df.memory_usage(deep=True).sum())
+        return nbytes
+
+    def summary(self):
+        return {
+            "questions": self.rows,
+            "files": len(self.fingerprint),
+            "source": self.source,
+            "build_seconds": round(self.build_seconds, 4),
+            "nbytes": self.nbytes,
+        }
+
+
+_bank = None
+_bank_lock = threading.Lock()
+
+
+def source_fingerprint(pattern="*.csv"):
+    """
+    (path, mtime, size) for every CSV matching pattern. Any change in the
+    set of files or their metadata invalidates the cached bank.
+    """
+    fingerprint = []
+    for path in sorted(glob.glob(pattern)):
+        stat = os.stat(path)
+        fingerprint.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(fingerprint)
+
+
+def read_csv_bank(csv_files):
+    # Read every cell as text so the compiled and CSV paths agree on types.
+    dfs = [pd.read_csv(file, dtype=str) for file in csv_files]
+    combined_df = pd.concat(dfs, ignore_index=True)
+    if "record_id" not in combined_df.columns:
+        combined_df["record_id"] = (combined_df.index + 1).astype(str)
+    else:
+        combined_df["record_id"] = combined_df["record_id"].astype(str)
+    return combined_df
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+def encode_bank(df, fingerprint):
+    """
+    Serialises df into the columnar format described in the module docstring.
+    """
+    columns = [str(column) for column in df.columns]
+    rows = len(df)
+
+    offsets = np.zeros((len(columns), rows + 1), dtype="<u8")
+    nulls = np.zeros((len(columns), rows), dtype="u1")
+    text = bytearray()
+    for c, column in enumerate(df.columns):
+        for pos, cell in enumerate(df[column].tolist()):
+            offsets[c, pos] = len(text)
+            if pd.isna(cell):
+                nulls[c, pos] = 1
+            else:
+                text += str(cell).encode("utf-8")
+        offsets[c, rows] = len(text)
+
+    slots = 8
+    while slots < 2 * rows:
+        slots *= 2
+    index = np.full(slots, -1, dtype="<i4")
+    for pos, record_id in enumerate(df["record_id"].astype(str).tolist()):
+        slot = zlib.crc32(record_id.encode("utf-8")) & (slots - 1)
+        while index[slot] >= 0:
+            if df["record_id"].iat[int(index[slot])] == record_id:
+                break  # Duplicate record_id: the first row wins.
+            slot = (slot + 1) & (slots - 1)
+        else:
+            index[slot] = pos
+
+    by_subject = {}
+    if "subject" in df.columns:
+        for pos, subject in enumerate(df["subject"].tolist()):
+            if not pd.isna(subject):
+                by_subject.setdefault(str(subject), []).append(pos)
+    subject_offsets = np.zeros(len(by_subject) + 1, dtype="<u4")
+    subject_positions = np.empty(sum(len(p) for p in by_subject.values()), dtype="<i4")
+    for i, subject_rows in enumerate(by_subject.values()):
+        subject_offsets[i + 1] = subject_offsets[i] + len(subject_rows)
+        subject_positions[subject_offsets[i]:subject_offsets[i + 1]] = subject_rows
+
+    payloads = [("offsets", offsets.tobytes()), ("nulls", nulls.tobytes()),
+                ("index", index.tobytes()),
+                ("subject_offsets", subject_offsets.tobytes()),
+                ("subject_positions", subject_positions.tobytes()),
+                ("text", bytes(text))]
+
+    header = {
+        "version": FORMAT_VERSION,
+        "rows": rows,
+        "columns": columns,
+        "sources": [list(entry) for entry in fingerprint],
+        "subjects": list(by_subject),
+        "sections": {},
+    }
+    # Section offsets depend on the header length, which depends on the
+    # offsets; reserve generous padding so one pass is enough.
+    header_json = json.dumps(header).encode("utf-8")
+    header_len = _align(len(header_json) + 64 * len(payloads) + 64)
+    position = 16 + header_len
+    for name, payload in payloads:
+        header["sections"][name] = [position, len(payload)]
+        position = _align(position + len(payload))
+    header_json = json.dumps(header).encode("utf-8")
+    assert len(header_json) <= header_len
+
+    out = bytearray(MAGIC + struct.pack("<Q", header_len) + header_json.ljust(header_len))
+    for name, payload in payloads:
+        out += payload
+        out += b"\0" * (_align(len(out)) - len(out))
+    return bytes(out)
+
+
+def compile_bank(pattern="*.csv", out_path=DEFAULT_COMPILED_PATH):
+    """
+    Compiles the CSVs matching pattern into out_path. The file is replaced
+    atomically so running servers keep their existing mapping.
+    """
+    fingerprint = source_fingerprint(pattern)
+    data = encode_bank(read_csv_bank([path for path, _, _ in fingerprint]), fingerprint)
+    tmp_path = f"{out_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, out_path)
+    return len(data)
+
+
+def open_compiled_bank(path=DEFAULT_COMPILED_PATH):
+    started = time.perf_counter()
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return QuestionBank(buffer, source="compiled", build_seconds=time.perf_counter() - started)
+
+
+def build_question_bank(pattern="*.csv", compiled_path=DEFAULT_COMPILED_PATH):
+    """
+    Opens compiled_path when it was compiled from the current CSVs (or when
+    no CSVs are deployed at all); otherwise parses the CSVs directly.
+    """
+    fingerprint = source_fingerprint(pattern)
+    if compiled_path and os.path.exists(compiled_path):
+        try:
+            bank = open_compiled_bank(compiled_path)
+            if not fingerprint or bank.fingerprint == fingerprint:
+                return bank
+        except ValueError:
+            pass  # Stale format; fall back to the CSVs.
+    started = time.perf_counter()
+    # The parsed DataFrame is dropped once encoded; bank.df decodes it again
+    # only if someone asks for it.
+    data = encode_bank(read_csv_bank([path for path, _, _ in fingerprint]), fingerprint)
+    return QuestionBank(data, source="csv", build_seconds=time.perf_counter() - started)
+
+
+def get_question_bank(pattern="*.csv", compiled_path=DEFAULT_COMPILED_PATH):
+    """
+    Returns the shared QuestionBank, rebuilding it only if the CSV files
+    matching pattern have changed since the last build. Each build logs the
+    bank's summary() (size, source and build time).
+    """
+    global _bank
+    fingerprint = source_fingerprint(pattern)
+    bank = _bank
+    if bank is not None and (not fingerprint or bank.fingerprint == fingerprint):
+        return bank
+    with _bank_lock:
+        # Another session may have rebuilt it while we waited for the lock.
+        current = source_fingerprint(pattern)
+        if _bank is None or (current and _bank.fingerprint != current):
+            _bank = build_question_bank(pattern, compiled_path)
+            logger.info("question bank built: %s", _bank.summary())
+        return _bank
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile the CSV question bank into a memory-mappable file.")
+    parser.add_argument("--pattern", default="*.csv", help="glob of REDCap CSV exports")
+    parser.add_argument("--out", default=DEFAULT_COMPILED_PATH, help="compiled bank path")
+    args = parser.parse_args()
+
+    nbytes = compile_bank(args.pattern, args.out)
+    bank = open_compiled_bank(args.out)
+    print(f"Wrote {args.out}: {len(bank)} questions, {nbytes} bytes, "
+          f"opened in {bank.build_seconds * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Exclusion-aware question sampling over bank row positions.
+
+Exams are drawn as integer positions into the shared QuestionBank rather than
+by filtering a copy of the DataFrame. Used/reserved questions are rejected
+through a bitmap over the bank, so in the common case a draw only touches
+O(k) positions and never copies question text.
+"""
+import numpy as np
+
+
+def exclusion_bitmap(bank, exclude=()):
+    """
+    Boolean array over every bank row; True marks a position that may not be drawn.
+    """
+    bitmap = np.zeros(len(bank), dtype=bool)
+    exclude = np.fromiter((int(pos) for pos in exclude), dtype=np.int64)
+    bitmap[exclude] = True
+    return bitmap
+
+
+def _draw(pool, k, bitmap, rng):
+    """
+    Draws up to k distinct positions from pool (None means every bank row)
+    that are not set in bitmap, marking each pick in bitmap. Tries cheap
+    rejection sampling first and falls back to an exact pass over pool when
+    most of it is excluded.
+    """
+    picked = []
+    n = len(bitmap) if pool is None else len(pool)
+    if k <= 0 or n == 0:
+        return picked
+
+    attempts = 4 * k + 32
+    while len(picked) < k and attempts > 0:
+        candidates = rng.integers(0, n, size=min(attempts, 2 * (k - len(picked)) + 8))
+        if pool is not None:
+            candidates = pool[candidates]
+        attempts -= len(candidates)
+        for pos in candidates:
+            if not bitmap[pos]:
+                bitmap[pos] = True
+                picked.append(int(pos))
+                if len(picked) == k:
+                    return picked
+
+    available = np.flatnonzero(~bitmap) if pool is None else pool[~bitmap[pool]]
+    if len(available):
+        rest = rng.choice(available, size=min(k - len(picked), len(available)), replace=False)
+        bitmap[rest] = True
+        picked.extend(int(pos) for pos in rest)
+    return picked
+
+
+def sample_positions(bank, k, pool=None, exclude=(), quotas=None, rng=None):
+    """
+    Samples up to k distinct row positions from bank.
+
+    pool     positions to draw from (default: the whole bank)
+    exclude  positions that must not be drawn (used or reserved questions)
+    quotas   optional {subject: count}, filled from each subject partition
+             (restricted to pool) before the rest of k is drawn from pool
+    rng      numpy Generator, e.g. np.random.default_rng(seed) for tests
+
+    Returns fewer than k positions when not enough questions are available.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    pool = None if pool is None else np.asarray(pool)
+    bitmap = exclusion_bitmap(bank, exclude)
+
+    picked = []
+    for subject, count in (quotas or {}).items():
+        subject_pool = bank.subject_positions(subject)
+        if pool is not None:
+            subject_pool = np.intersect1d(subject_pool, pool)
+        picked.extend(_draw(subject_pool, min(count, k - len(picked)), bitmap, rng))
+    picked.extend(_draw(pool, k - len(picked), bitmap, rng))
+    return picked
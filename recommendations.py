@@ -0,0 +1,43 @@
+"""
+Lookup key for the "recommendations" collection.
+
+Recommendation documents carry a "user_key" field, the normalised user name,
+so the student app finds a student's recommendations with one equality
+query. The documents are written outside this repo, so the field is added
+by backfill_recommendation_keys(): from `python maintenance.py
+backfill-recommendation-keys` and on every pass of the record sweeper
+(sweeper.py). Both the app and the backfill derive the key here, so the
+backfilled values always match the queries.
+"""
+# Firestore allows at most 500 writes per batch.
+BATCH_SIZE = 400
+
+
+def normalize_user_name(user_name):
+    """
+    Key used to look up a student's recommendations: the name, trimmed and lower-cased.
+    """
+    return str(user_name).strip().lower()
+
+
+def backfill_recommendation_keys(db, batch_size=BATCH_SIZE):
+    """
+    Adds the normalised "user_key" field that the student app queries on
+    to every recommendation document that is missing it or has a stale one.
+    Returns the number of documents updated.
+    """
+    updated = 0
+    batch = db.batch()
+    for doc_id, data in db.query("recommendations"):
+        if not data.get("user_name"):
+            continue
+        user_key = normalize_user_name(data["user_name"])
+        if data.get("user_key") != user_key:
+            batch.set("recommendations", doc_id, {"user_key": user_key}, merge=True)
+            updated += 1
+            if len(batch) >= batch_size:
+                batch.commit()
+                batch = db.batch()
+    if len(batch):
+        batch.commit()
+    return updated
@@ -0,0 +1,199 @@
+"""
+Digest mode for the review emails.
+
+Instead of one single-question email per completion, each review item is
+stored in the "review_digest_items" collection. Once the oldest item for a
+recipient is older than the digest window, all of that recipient's items are
+rendered into one multi-question document and queued in the email outbox as
+a single message (the items are deleted in the same batch). Recipients with
+many items get several messages, each small enough for one outbox document.
+The items are claimed in a transaction before they are rendered, as outbox
+messages are, so the outbox workers of several processes and `python
+maintenance.py drain-outbox` never queue the same item twice.
+
+Enabled by st.secrets["review_email"]["digest_minutes"] > 0; without it every
+completion is emailed on its own as before.
+"""
+import collections
+import datetime
+import logging
+import os
+
+from outbox import CLAIM_SECONDS, enqueue_email
+from review_doc import add_heading, add_review_question, document_bytes, new_review_document
+from storage import SERVER_TIMESTAMP, new_doc_id
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = "review_digest_items"
+# Keeps a digest's writes (its deletes plus the outbox message) inside one
+# Firestore batch of at most 500 writes.
+MAX_ITEMS_PER_DIGEST = 100
+# The .docx is stored in the outbox message, and a Firestore document may
+# hold at most 1 MiB; this leaves room for the message's other fields.
+MAX_ATTACHMENT_BYTES = 800 * 1024
+QUESTION_FIELDS = ("record_id", "question", "anchor",
+                   "answerchoice_a", "answerchoice_b", "answerchoice_c", "answerchoice_d", "answerchoice_e",
+                   "correct_answer", "answer_explanation")
+
+
+def digest_window(secrets):
+    """
+    Returns the configured digest window as a timedelta, or None when
+    digests are disabled.
+    """
+    if "review_email" not in secrets:
+        return None
+    minutes = float(secrets["review_email"].get("digest_minutes", 0) or 0)
+    return datetime.timedelta(minutes=minutes) if minutes > 0 else None
+
+
+def _plain(value):
+    # NaN and other missing values are stored as None.
+    return str(value) if isinstance(value, str) else None
+
+
+def enqueue_review_item(db, recipient, student_name, row, user_selected_letter, image_path=None, batch=None):
+    """
+    Stores one review item for recipient's next digest.
+    """
+    data = {
+        "recipient": recipient,
+        "student_name": student_name,
+        "question": {field: _plain(row.get(field)) for field in QUESTION_FIELDS},
+        "selected_letter": user_selected_letter,
+        "image_path": image_path,
+        "created_at": SERVER_TIMESTAMP,
+    }
+    if batch is not None:
+        batch.set(COLLECTION, new_doc_id(), data)
+    else:
+        db.set(COLLECTION, new_doc_id(), data)
+
+
+def render_digest_doc(items):
+    """
+    Renders several review items (dicts as stored by enqueue_review_item)
+    into one document and returns the .docx bytes.
+    """
+    doc = new_review_document()
+    doc.paragraphs[0].text = f"Review of Incorrect Questions ({len(items)})"
+    for item in items:
+        add_heading(doc, f"Student: {item['student_name']}")
+        add_review_question(doc, item["question"], item["selected_letter"], item.get("image_path"))
+    return document_bytes(doc)
+
+
+def _estimated_size(item, images):
+    # The embedded JPEG dominates; python-docx stores it as is, and only once
+    # per document however many questions show it.
+    size = sum(len(value) for value in item["question"].values() if value)
+    image_path = item.get("image_path")
+    if image_path and image_path not in images:
+        try:
+            size += os.path.getsize(image_path)
+        except OSError:
+            pass
+    return size
+
+
+def _packed(items):
+    # Greedy split on the estimated size, so most chunks render small enough
+    # on the first try.
+    chunk, size, images = [], 0, set()
+    for pair in items:
+        item_size = _estimated_size(pair[1], images)
+        if chunk and (len(chunk) >= MAX_ITEMS_PER_DIGEST or size + item_size > MAX_ATTACHMENT_BYTES):
+            yield chunk
+            chunk, size, images = [], 0, set()
+            item_size = _estimated_size(pair[1], images)
+        chunk.append(pair)
+        size += item_size
+        images.add(pair[1].get("image_path"))
+    if chunk:
+        yield chunk
+
+
+def digest_chunks(items):
+    """
+    Splits (item_id, item) pairs into digests of at most MAX_ITEMS_PER_DIGEST
+    items whose rendered document is at most MAX_ATTACHMENT_BYTES, keeping
+    their order. Yields (chunk, .docx bytes).
+    """
+    pending = list(_packed(items))
+    while pending:
+        chunk = pending.pop(0)
+        attachment = render_digest_doc([item for _, item in chunk])
+        if len(attachment) > MAX_ATTACHMENT_BYTES:
+            if len(chunk) > 1:
+                half = len(chunk) // 2
+                pending[:0] = [chunk[:half], chunk[half:]]
+                continue
+            # A single question whose image alone is too large: send it without.
+            logger.warning("review digest: item %s is %d bytes; sending it without its image",
+                           chunk[0][0], len(attachment))
+            attachment = render_digest_doc([dict(chunk[0][1], image_path=None)])
+        yield chunk, attachment
+
+
+def _claimed(item, now):
+    return bool(item.get("claimed_until")) and item["claimed_until"] > now
+
+
+def claim_items(db, items, now=None):
+    """
+    Reserves (item_id, item) pairs for this caller for CLAIM_SECONDS, one
+    transaction each. Returns the pairs it now holds, with the items as read
+    in the transaction; items held by another worker or already gone are left
+    out.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    token = new_doc_id()
+
+    def claim(item):
+        if item is None or _claimed(item, now):
+            return None
+        return {"claimed_by": token, "claimed_until": now + datetime.timedelta(seconds=CLAIM_SECONDS)}
+
+    held = []
+    for item_id, _ in items:
+        item = db.transform(COLLECTION, item_id, claim)
+        if item is not None and item.get("claimed_by") == token:
+            held.append((item_id, item))
+    return held
+
+
+def flush_digests(db, window, now=None):
+    """
+    Queues one digest email per recipient whose oldest item has waited at
+    least window (split by digest_chunks()). Only items claimed by this call
+    are sent and deleted. Returns the number of digests queued.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    by_recipient = collections.defaultdict(list)
+    for item_id, item in db.query(COLLECTION):
+        # Items claimed by another worker are being sent by it.
+        if not _claimed(item, now):
+            by_recipient[item["recipient"]].append((item_id, item))
+
+    queued = 0
+    for recipient, items in by_recipient.items():
+        items.sort(key=lambda pair: pair[1]["created_at"])
+        if items[0][1]["created_at"] + window > now:
+            continue
+        for chunk, attachment in digest_chunks(claim_items(db, items, now)):
+            batch = db.batch()
+            enqueue_email(
+                db,
+                to_emails=[recipient],
+                subject=f"Review of Incorrect Questions ({len(chunk)} students)",
+                body="Please find attached review documents for questions answered incorrectly.",
+                attachment=attachment,
+                filename=f"review_digest_{now:%Y%m%d_%H%M}.docx",
+                batch=batch,
+            )
+            for item_id, _ in chunk:
+                batch.delete(COLLECTION, item_id)
+            batch.commit()
+            queued += 1
+    return queued
@@ -0,0 +1,108 @@
+"""
+Rendering of the review documents attached to the review emails.
+
+Documents are rendered straight to bytes: nothing is written to the working
+directory, so concurrent completions cannot collide on a file name. Every
+document starts from one base template (the default styles plus the title
+heading) that is built and serialised once per process and then parsed
+from memory, instead of assembling a fresh Document() from the python-docx
+package files each time. Heading style ids are resolved once with it.
+"""
+import io
+import threading
+
+import pandas as pd
+from docx import Document
+from docx.shared import Inches
+
+TITLE = "Review of Incorrect Question"
+
+_template = None
+_heading_style_ids = {}
+_template_lock = threading.Lock()
+
+
+def _template_bytes():
+    global _template
+    with _template_lock:
+        if _template is None:
+            doc = Document()
+            doc.add_heading(TITLE, level=1)
+            # Resolving a style name walks every style definition, which made
+            # up most of the render time; look the heading ids up only once.
+            for level in (1, 2):
+                _heading_style_ids[level] = doc.styles[f"Heading {level}"].style_id
+            _template = document_bytes(doc)
+        return _template
+
+
+def add_heading(doc, text, level=2):
+    """
+    Same result as doc.add_heading(), using the style id cached with the template.
+    """
+    _template_bytes()
+    paragraph = doc.add_paragraph(text)
+    paragraph._p.get_or_add_pPr().style = _heading_style_ids[level]
+    return paragraph
+
+
+def new_review_document():
+    """
+    Returns a Document parsed from the cached base template.
+    """
+    return Document(io.BytesIO(_template_bytes()))
+
+
+def add_review_question(doc, row, user_selected_letter, image_path=None):
+    """
+    Appends one question (text, image, choices, student and correct answer,
+    explanation) to doc.
+    """
+    add_heading(doc, f"Question {row['record_id']}:")
+    doc.add_paragraph(row["question"])
+
+    if image_path:
+        try:
+            doc.add_picture(image_path, width=Inches(4))
+        except Exception as e:
+            doc.add_paragraph(f"(Image could not be added: {e})")
+
+    if "anchor" in row:
+        doc.add_paragraph(row["anchor"])
+
+    add_heading(doc, "Answer Choices:")
+    for letter in ["a", "b", "c", "d", "e"]:
+        col_name = "answerchoice_" + letter
+        if pd.notna(row[col_name]) and str(row[col_name]).strip():
+            doc.add_paragraph(f"{letter.upper()}: {row[col_name]}")
+
+    add_heading(doc, "Student Answer:")
+    if user_selected_letter:
+        user_answer_text = row.get("answerchoice_" + user_selected_letter, "N/A")
+        doc.add_paragraph(user_answer_text)
+    else:
+        doc.add_paragraph("No answer selected.")
+
+    correct_letter = str(row["correct_answer"]).strip().lower()
+    correct_answer_text = row.get("answerchoice_" + correct_letter, "N/A")
+    add_heading(doc, "Correct Answer:")
+    doc.add_paragraph(correct_answer_text)
+
+    add_heading(doc, "Explanation:")
+    doc.add_paragraph(row["answer_explanation"])
+
+
+def document_bytes(doc):
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def render_review_doc(student_name, row, user_selected_letter, image_path=None):
+    """
+    Renders the single-question review for one student and returns the .docx bytes.
+    """
+    doc = new_review_document()
+    add_heading(doc, f"Student: {student_name}")
+    add_review_question(doc, row, user_selected_letter, image_path)
+    return document_bytes(doc)
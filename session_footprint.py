@@ -0,0 +1,187 @@
+"""
+Memory accounting for the Streamlit sessions.
+
+Measures the deep size of every session-state key of every live session and
+the process RSS, so the server can be sized for a given number of concurrent
+students:
+
+    estimated RSS = current RSS + (target - active sessions) * mean session size
+
+Objects shared by all sessions (the question bank and its QuestionRecords,
+the cached images) are not session state and are part of the baseline RSS.
+
+Shown on the ?footprint admin page (see admin.py). benchmarks/load_test.py prints the same
+per-key table for its simulated students.
+"""
+import collections
+import sys
+import types
+
+import numpy as np
+import pandas as pd
+
+# Sizing target for the admin page's projection.
+TARGET_SESSIONS = 500
+
+KeyStats = collections.namedtuple("KeyStats", ["key", "sessions", "mean_bytes", "max_bytes", "total_bytes"])
+
+# Never descended into: they belong to the process, not to a session.
+_SKIP_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    Bytes held by obj and everything it references (containers, instance
+    attributes and slots), counting each object once. pandas and numpy
+    objects are measured by their own deep memory usage.
+    """
+    seen = set() if seen is None else seen
+    total = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _SKIP_TYPES):
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, (pd.DataFrame, pd.Series, pd.Index)):
+            usage = obj.memory_usage(deep=True)
+            total += int(usage.sum() if hasattr(usage, "sum") else usage)
+            continue
+        if isinstance(obj, np.ndarray):
+            total += sys.getsizeof(obj) + (obj.nbytes if obj.base is None else 0)
+            continue
+        total += sys.getsizeof(obj)
+        if isinstance(obj, (str, bytes, bytearray, int, float, bool, complex)) or obj is None:
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+            stack.extend(obj)
+        if hasattr(obj, "__dict__"):
+            stack.append(vars(obj))
+        for slot in getattr(type(obj), "__slots__", ()):
+            if hasattr(obj, slot):
+                stack.append(getattr(obj, slot))
+    return total
+
+
+def key_sizes(state):
+    """
+    {key: deep size in bytes} for a session-state mapping. Each key is
+    measured on its own, so objects shared between keys count for both.
+    """
+    return {str(key): deep_sizeof(value) for key, value in state.items()}
+
+
+def process_rss():
+    """
+    Current resident set size of this process in bytes (peak RSS where
+    /proc is not available).
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and bytes on macOS.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def live_session_states():
+    """
+    [(session_id, state dict)] for every session the Streamlit server holds,
+    connected or not. Empty when not running under `streamlit run`.
+    """
+    from streamlit.runtime import Runtime
+
+    if not Runtime.exists():
+        return []
+    # There is no public API for other sessions' state; report none rather
+    # than fail if the private one changes.
+    session_mgr = getattr(Runtime.instance(), "_session_mgr", None)
+    if not hasattr(session_mgr, "list_sessions"):
+        return []
+    states = []
+    for info in session_mgr.list_sessions():
+        try:
+            states.append((info.session.id, dict(info.session.session_state.filtered_state)))
+        except Exception:
+            continue  # Session shutting down.
+    return states
+
+
+def summarize(per_session):
+    """
+    KeyStats per key, largest total first, from a list of key_sizes() dicts.
+    """
+    sizes = collections.defaultdict(list)
+    for session in per_session:
+        for key, size in session.items():
+            sizes[key].append(size)
+    stats = [KeyStats(key, len(values), sum(values) / len(values), max(values), sum(values))
+             for key, values in sizes.items()]
+    return sorted(stats, key=lambda s: s.total_bytes, reverse=True)
+
+
+def footprint_report(target=TARGET_SESSIONS):
+    """
+    Per-key sizes over the live sessions, process RSS and the projected RSS
+    for target concurrent sessions.
+    """
+    per_session = [key_sizes(state) for _, state in live_session_states()]
+    rss = process_rss()
+    mean_session = sum(sum(s.values()) for s in per_session) / len(per_session) if per_session else 0
+    return {
+        "sessions": len(per_session),
+        "rss": rss,
+        "mean_session_bytes": mean_session,
+        "projected_rss": rss + max(target - len(per_session), 0) * mean_session,
+        "target": target,
+        "keys": summarize(per_session),
+    }
+
+
+def format_stats(stats):
+    lines = [f"{'key':<24} {'sessions':>8} {'mean KiB':>9} {'max KiB':>9} {'total KiB':>10}"]
+    for s in stats:
+        lines.append(f"{s.key:<24} {s.sessions:>8} {s.mean_bytes / 1024:>9.1f} "
+                     f"{s.max_bytes / 1024:>9.1f} {s.total_bytes / 1024:>10.1f}")
+    return "\n".join(lines)
+
+
+def footprint_page(secrets):
+    """
+    Admin-only page with the session memory report.
+    """
+    import streamlit as st
+
+    from admin import require_admin
+    from question_bank import get_question_bank
+
+    st.title("Session Memory")
+    if not require_admin(secrets):
+        return
+
+    target = st.number_input("Concurrent students", min_value=1, value=TARGET_SESSIONS, step=50)
+    report = footprint_report(int(target))
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Sessions", report["sessions"])
+    col2.metric("Process RSS", f"{report['rss'] / 2**20:.0f} MiB")
+    col3.metric(f"Projected RSS ({report['target']} sessions)", f"{report['projected_rss'] / 2**20:.0f} MiB")
+    st.write(f"Mean session state: {report['mean_session_bytes'] / 1024:.1f} KiB")
+    bank = get_question_bank().summary()
+    st.write(f"Question bank (shared, part of the baseline): {bank['questions']} questions from "
+             f"{bank['source']}, {bank['nbytes'] / 2**20:.1f} MiB, built in {bank['build_seconds'] * 1000:.0f} ms")
+    if report["keys"]:
+        st.dataframe(pd.DataFrame([{
+            "key": s.key,
+            "sessions": s.sessions,
+            "mean KiB": round(s.mean_bytes / 1024, 1),
+            "max KiB": round(s.max_bytes / 1024, 1),
+            "total KiB": round(s.total_bytes / 1024, 1),
+        } for s in report["keys"]]), hide_index=True)
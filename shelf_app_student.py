@@ -1,7 +1,5 @@
 import streamlit as st
-import pandas as pd
-import os
-import glob
+import numpy as np
 import random
 import datetime
 import re
@@ -15,18 +13,45 @@ from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
 
-import firebase_admin
-from firebase_admin import credentials, firestore
+from storage import open_storage, new_doc_id, SERVER_TIMESTAMP, DELETE_FIELD
+from exam_state import (exam_records, flush_exam_state, mark_exam_state_saved, rerun,
+                        save_exam_state, set_exam_questions, write_doc)
+import passcode_status
+from passcode_status import get_passcode_status, is_locked, remember_lock
+from passcodes import get_passcode_registry
+from recommendations import normalize_user_name
+from question_bank import get_question_bank
+from question_sampler import sample_positions
+from question_assets import prefetch_question, question_assets
+from admin import admin_page
+from tracing import TracedStorage, trace_phase
+from sweeper import start_sweeper
 
 # Set wide layout
 st.set_page_config(layout="wide")
 
-# Initialize Firebase if not already done.
-firebase_creds = st.secrets["firebase_service_account"].to_dict()
-if not firebase_admin._apps:
-    cred = credentials.Certificate(firebase_creds)
-    firebase_admin.initialize_app(cred)
-db = firestore.client()
+@st.cache_resource
+def get_storage():
+    # Firestore by default; SHELF_STORAGE=memory or sqlite:<path> for local runs.
+    return TracedStorage(open_storage(st.secrets))
+
+db = get_storage()
+
+@st.cache_resource
+def get_sweeper():
+    # Expires old records in batched deletes, off the login path (sweeper.py).
+    return start_sweeper(db, st.secrets)
+
+get_sweeper()
+
+def passcode_registry():
+    # [recipients] compiled once (and again when the secrets change).
+    return get_passcode_registry(st.secrets)
+
+# Built at startup so malformed [recipients] entries are logged before anyone
+# tries to log in with them.
+if "recipients" in st.secrets:
+    passcode_registry()
 
 ### Helper functions to manage exam state in Firestore
 
@@ -47,193 +72,158 @@ def initialize_state():
         st.session_state.assigned_passcode = ""
     if "recipient_email" not in st.session_state:
         st.session_state.recipient_email = ""
-    if "df" not in st.session_state:
-        st.session_state.df = None
+    if "question_positions" not in st.session_state:
+        st.session_state.question_positions = ()
+    if "bank_version" not in st.session_state:
+        st.session_state.bank_version = None
+    if "question_flags" not in st.session_state:
+        st.session_state.question_flags = ()
     if "result_message" not in st.session_state:
         st.session_state.result_message = ""
     if "result_color" not in st.session_state:
         st.session_state.result_color = ""
-    if "result_messages" not in st.session_state:
-        st.session_state.result_messages = []
+    if "saved_exam_state" not in st.session_state:
+        st.session_state.saved_exam_state = {}
+    if "pending_exam_state" not in st.session_state:
+        st.session_state.pending_exam_state = {}
     if "question_ids" not in st.session_state:
         st.session_state.question_ids = []
+    if "completion_token" not in st.session_state:
+        st.session_state.completion_token = ""
+    if "completion_summary" not in st.session_state:
+        st.session_state.completion_summary = None
 
-def get_user_key():
-    # Use the entire assigned passcode as the key.
-    return str(st.session_state.assigned_passcode)
-
-def save_exam_state():
-    user_key = get_user_key()
-    data = {
-        "question_index": st.session_state.question_index,
-        "score": st.session_state.score,
-        "results": st.session_state.results,
-        "selected_answers": st.session_state.selected_answers,
-        "result_messages": st.session_state.result_messages,
-        "question_ids": st.session_state.question_ids,
-        "email_sent": st.session_state.get("email_sent", False),
-        "exam_complete": st.session_state.get("exam_complete", False), 
-        "timestamp": firestore.SERVER_TIMESTAMP,
-    }
-    db.collection("exam_sessions").document(user_key).set(data)
+def question_flag(index):
+    """
+    "pending" (repeat question), "recommended" or "" for the exam question at
+    index. Flags are only known for exams created in this session.
+    """
+    flags = st.session_state.question_flags
+    return flags[index] if index < len(flags) else ""
 
-def create_new_exam(full_df):
-    used_ids            = get_global_used_questions()
-    pending_rec_id      = get_pending_recommendation_for_user(st.session_state.user_name)
+def create_new_exam(pool=None, batch=None):
+    """
+    Samples 5 questions from pool (bank positions, default: the whole bank),
+    including any pending repeat and one clerkship-recommended question.
+    """
+    bank                = get_question_bank()
+    rng                 = np.random.default_rng()
+    used_ids, expired_ids = get_global_used_questions()
+    pending_doc_id, pending_rec_id = get_pending_recommendation_for_user(st.session_state.user_name)
     recommended_subject   = st.session_state.get("recommended_subject")
     
-    # We'll build a list of “special” DataFrames + flag markers:
-    special_dfs   = []
-    special_types = []  # parallel list: "pending" or "recommended"
+    # We'll build a list of “special” bank positions + flag markers:
+    special_positions = []
+    special_types     = []  # parallel list: "pending" or "recommended"
     
-    # 1️⃣ pending question, if any
+    # 1️⃣ pending question, if any; it is used up with this exam's writes
+    if pending_doc_id:
+        if batch is not None:
+            batch.delete("pending_recommendations", pending_doc_id)
+        else:
+            db.delete("pending_recommendations", pending_doc_id)
     if pending_rec_id:
-        df_pend = full_df[full_df["record_id"] == pending_rec_id]
-        if not df_pend.empty:
-            special_dfs.append(df_pend.iloc[[0]].copy())
+        pend_pos = bank.position(pending_rec_id)
+        if pend_pos is not None:
+            special_positions.append(pend_pos)
             special_types.append("pending")
     
-    # 2️⃣ subject‐based recommendation (always separate)
-
+    # 2️⃣ subject‐based recommendation (always separate), drawn from the pool only
     if recommended_subject:
-        df_rec = full_df[full_df["subject"] == recommended_subject]
-        if not df_rec.empty:
-            pick = df_rec.sample(1).copy()
-            rid  = pick.iloc[0]["record_id"]
-            if rid not in used_ids:
-                special_dfs.append(pick)
+        rec_positions = bank.subject_positions(recommended_subject)
+        if pool is not None:
+            rec_positions = np.intersect1d(rec_positions, pool)
+        if len(rec_positions):
+            pick = int(rng.choice(rec_positions))
+            if bank.value("record_id", pick) not in used_ids and pick not in special_positions:
+                special_positions.append(pick)
                 special_types.append("recommended")
     # ----------------------------------------------------------
     # Exclude all recently used *and* any specials (so we can prepend them later)
-    exclude     = used_ids + [df_sp.iloc[0]["record_id"] for df_sp in special_dfs]
-    filtered_df = full_df[~full_df["record_id"].isin(exclude)]
+    exclude     = bank.positions(used_ids) + special_positions
     
     # 4. Determine how many remaining questions to sample.    
-    n_special   = len(special_dfs)
-    remaining_n = 5 - n_special
-    
-    if len(filtered_df) >= remaining_n:
-        sample_df = filtered_df.sample(n=remaining_n, replace=False)
-    else:
-        sample_df = filtered_df.sample(n=remaining_n, replace=True)
-    
-    # 5. If there is a recommended question, insert it into the sample.
-    if special_dfs:
-        sample_df = pd.concat(special_dfs + [sample_df], ignore_index=True)
+    remaining_n = 5 - len(special_positions)
+    positions   = sample_positions(bank, remaining_n, pool=pool, exclude=exclude, rng=rng)
+    if positions and len(positions) < remaining_n:
+        # Not enough unused questions left: top up with repeats.
+        positions += [int(pos) for pos in rng.choice(positions, remaining_n - len(positions))]
+    
+    if not positions and not special_positions:
+        st.error("No further cases available for your passcode. Please try again later.")
+        st.stop()
     
-    sample_df = sample_df.sample(frac=1).reset_index(drop=True)
+    # 5. Insert the special questions and shuffle.
+    positions = [int(pos) for pos in rng.permutation(special_positions + positions)]
+    set_exam_questions(bank, positions)
 
-    # ensure every row has both flags
-    sample_df["pending_flag"]     = False
-    sample_df["recommended_flag"] = False
-    
-    for df_sp, typ in zip(special_dfs, special_types):
-         rid = df_sp.iloc[0]["record_id"]
-         if typ == "pending":
-             sample_df.loc[sample_df["record_id"] == rid, "pending_flag"] = True
-         else:
-             sample_df.loc[sample_df["record_id"] == rid, "recommended_flag"] = True
-
-         if typ == "pending" and rid in used_ids:
-             used_ids.remove(rid)                   
-    
-    st.session_state.df               = sample_df
-    st.session_state.question_ids     = sample_df["record_id"].tolist()
-    total_questions                   = len(sample_df)
+    # "pending" / "recommended" / "" for each question, in exam order
+    special = dict(zip(special_positions, special_types))
+    st.session_state.question_flags   = tuple(special.get(pos, "") for pos in positions)
+    total_questions                   = len(positions)
     st.session_state.results          = [None] * total_questions
     st.session_state.selected_answers = [None] * total_questions
-    st.session_state.result_messages  = [""]    * total_questions
+    st.session_state.saved_exam_state   = {}
+    st.session_state.pending_exam_state = {}
+    st.session_state.completion_token   = new_doc_id()
     
     # 3) Mark questions as used
-    mark_questions_as_used(sample_df["record_id"].tolist())
+    mark_questions_as_used(st.session_state.question_ids, expired_ids, batch)
 
-def is_passcode_locked(passcode, lock_hours=6):
+def is_passcode_locked(passcode, lock_hours=6, fresh=False):
     """
     Checks if the passcode is locked.
     Returns True if locked (i.e. the passcode was locked within the last lock_hours),
-    otherwise returns False.
+    otherwise returns False. The status is cached; pass fresh=True to re-read it.
     """
-    doc_ref = db.collection("locked_passcodes").document(str(passcode))
-    doc = doc_ref.get()
-    if doc.exists:
-        data = doc.to_dict()
-        lock_time = data.get("lock_time")
-        if lock_time is not None:
-            # lock_time is already a timezone-aware datetime.
-            now = datetime.datetime.now(datetime.timezone.utc)
-            delta = now - lock_time
-            if delta.total_seconds() < lock_hours * 3600:
-                return True
-    return False
-
-
-def lock_passcode(passcode):
+    return is_locked(get_passcode_status(db, passcode, fresh=fresh), lock_hours)
+
+
+def lock_passcode(passcode, batch=None):
     """
     Locks the passcode by writing the current server timestamp to Firestore.
     This marks the passcode as used and locked for 6 hours.
     """
-    doc_ref = db.collection("locked_passcodes").document(str(passcode))
     # Set the lock time to the server timestamp.
-    doc_ref.set({"lock_time": firestore.SERVER_TIMESTAMP})
-
-def get_image_path(record_id, folder="images"):
-    extensions = ["jpg", "jpeg", "png", "gif"]
-    for ext in extensions:
-        pattern = os.path.join(folder, f"{record_id}.{ext}")
-        matches = glob.glob(pattern)
-        if matches:
-            return matches[0]
-    return None
+    passcode_status.lock_passcode(db, passcode, batch)
 
 def get_global_used_questions():
     """
-    Retrieves a list of question record_ids that have been used in the last 7 days
-    for the current user. Documents older than 7 days are deleted so questions can be reused.
+    Retrieves the question record_ids the current user has been given in the last 7 days.
+    Each user has a single "used_questions" document holding a {record_id: timestamp} map,
+    so this is one read. Also returns the record_ids whose entries are older than 7 days;
+    mark_questions_as_used() drops those in its write instead of deleting documents here.
     """
-    used_questions_ref = db.collection("global_used_questions")
-    # Query for documents where "user" equals the current user's name.
-    query = used_questions_ref.where("user", "==", st.session_state.user_name).stream()
-    
-    used_ids = []
-    now = datetime.datetime.utcnow()
-    for doc in query:
-        data = doc.to_dict()
-        ts = data.get("timestamp")
-        if ts is not None:
-            ts_naive = ts.replace(tzinfo=None)
-            if (now - ts_naive).total_seconds() < 7 * 24 * 3600:
-                used_ids.append(data.get("record_id"))
-            else:
-                # Delete outdated documents so questions become available.
-                doc.reference.delete()
-    return used_ids
+    data = db.get("used_questions", st.session_state.user_name)
+    used = data.get("used", {}) if data is not None else {}
+    
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=7)
+    used_ids, expired_ids = [], []
+    for record_id, ts in used.items():
+        if ts is not None and ts > cutoff:
+            used_ids.append(record_id)
+        else:
+            expired_ids.append(record_id)
+    return used_ids, expired_ids
 
 
-def mark_questions_as_used(question_ids):
-    used_questions_ref = db.collection("global_used_questions")
+def mark_questions_as_used(question_ids, expired_ids=(), batch=None):
+    """
+    Records question_ids as used by the current user (and removes expired_ids)
+    with a single merge write to their "used_questions" document.
+    """
+    used = {str(rid): DELETE_FIELD for rid in expired_ids}
     for qid in question_ids:
-        # Create a compound key: userName_recordID
-        doc_id = f"{st.session_state.user_name}_{qid}"
-        used_questions_ref.document(doc_id).set({
-            "record_id": qid,
-            "user": st.session_state.user_name,
-            "used": True,
-            "timestamp": firestore.SERVER_TIMESTAMP
-        })
+        used[str(qid)] = SERVER_TIMESTAMP
+    write_doc(db, "used_questions", st.session_state.user_name, {
+        "user": st.session_state.user_name,
+        "used": used,
+    }, batch, merge=True)
         
-def load_data(pattern="*.csv"):
-    csv_files = glob.glob(pattern)
-    dfs = [pd.read_csv(file) for file in csv_files]
-    combined_df = pd.concat(dfs, ignore_index=True)
-    if "record_id" not in combined_df.columns:
-        combined_df["record_id"] = (combined_df.index + 1).astype(str)
-    else:
-        combined_df["record_id"] = combined_df["record_id"].astype(str)
-    return combined_df
-
-def store_pending_recommendation_if_incorrect():
+def store_pending_recommendation_if_incorrect(batch=None):
     """
     Pick one wrong question at random and store it with next_due = now +48h.
+    Returns its record_id, or None when every answer was correct.
     """
     # Collect all indices answered incorrectly
     wrong_idxs = [
@@ -241,52 +231,66 @@ def store_pending_recommendation_if_incorrect():
         if result == "incorrect"
     ]
     if not wrong_idxs:
-        return
+        return None
 
     # Pick one at random
     idx = random.choice(wrong_idxs)
-    row = st.session_state.df.iloc[idx]
+    record_id = st.session_state.question_ids[idx]
 
     due_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=48)
     pending_data = {
         "user_name":  st.session_state.user_name,
-        "record_id":  row["record_id"],
+        "record_id":  record_id,
         "next_due":   due_time,
     }
-    db.collection("pending_recommendations").add(pending_data)
-    st.write(f"🔖 Stored pending question for record {row['record_id']} (re-admin in 48 h).")
+    # One per exam: keyed by the completion token, like the exam result.
+    write_doc(db, "pending_recommendations", st.session_state.completion_token, pending_data, batch)
+    return record_id
 
 
 def get_pending_recommendation_for_user(user_name):
+    """
+    Returns (doc_id, record_id) of the user's earliest due pending question,
+    or (None, None). Read only: create_new_exam() deletes the document in the
+    new exam's batch.
+    """
     now = datetime.datetime.now(datetime.timezone.utc)
     #st.write("DEBUG: Current UTC time:", now)
     
     # Query documents for this user with next_due <= now.
-    query = db.collection("pending_recommendations") \
-              .where("user_name", "==", user_name) \
-              .where("next_due", "<=", now) \
-              .stream()
-    
-    pending_recs = list(query)
+    pending_recs = db.query("pending_recommendations", [
+        ("user_name", "==", user_name),
+        ("next_due", "<=", now),
+    ])
     #st.write("DEBUG: Found", len(pending_recs), "pending recommendations for user", user_name)
     
-    # Log each document's next_due for inspection.
-    for doc in pending_recs:
-        data = doc.to_dict()
-        #st.write("DEBUG: Doc ID", doc.id, "next_due:", data.get("next_due"))
-    
     if pending_recs:
         # Sort by the next_due field (ascending) so that the earliest one is used.
-        pending_docs = sorted(pending_recs, key=lambda doc: doc.to_dict().get("next_due"))
-        pending_doc = pending_docs[0]
-        pending_data = pending_doc.to_dict()
+        pending_id, pending_data = min(pending_recs, key=lambda rec: rec[1].get("next_due"))
         #st.write("DEBUG: Using pending recommendation:", pending_data)
-        # Delete the pending recommendation after retrieving it.
-        pending_doc.reference.delete()
-        return pending_data["record_id"]
-    return None
+        return pending_id, pending_data["record_id"]
+    return None, None
 
-def save_exam_results():
+@st.cache_data(ttl=300, show_spinner=False)
+def get_recommended_subjects(user_name):
+    """
+    Returns the distinct subjects recommended for user_name.
+    Runs one equality query on the "user_key" field (see recommendations.py)
+    and caches the answer in-process for 5 minutes. Documents written since
+    the last backfill have no user_key yet, so when nothing matches it falls
+    back to the raw "user_name" field.
+    """
+    recs = db.query("recommendations", [("user_key", "==", normalize_user_name(user_name))])
+    if not recs:
+        recs = db.query("recommendations", [("user_name", "==", user_name)])
+    subjects = []
+    for _, rec_data in recs:
+        subject = rec_data.get("subject")
+        if subject is not None and subject not in subjects:
+            subjects.append(subject)
+    return subjects
+
+def save_exam_results(batch=None):
     """
     Collects exam results details and saves them to the 'exam_results' collection in Firestore.
     The details include for each question:
@@ -296,21 +300,21 @@ def save_exam_results():
       - a result flag ("Correct" or "Incorrect")
       - a flag indicating if the question is clerkship recommended.
     It also saves the student's name, the passcode used, and the overall score.
+    Returns the record_id stored as a pending repeat question, if any.
     """
     
     exam_data = []
-    df = st.session_state.df  # This is the exam DataFrame for this session.
+    records = exam_records()
 
-    for idx, row in df.iterrows():
+    for idx, question in enumerate(records):
         record = {}
-        record["record_id"] = row["record_id"]
+        record["record_id"] = st.session_state.question_ids[idx]
         student_ans = st.session_state.selected_answers[idx]
         record["student_answer"] = student_ans if student_ans is not None else ""
-        correct_letter = str(row["correct_answer"]).strip().lower()
-        correct_answer_text = row.get("answerchoice_" + correct_letter, "")
-        record["correct_answer"] = correct_answer_text
+        correct_letter = question.correct_letter if question else ""
+        record["correct_answer"] = question.answer_text(correct_letter) if question else ""
         record["result"] = "Correct" if student_ans and student_ans == correct_letter else "Incorrect"
-        record["clerkship_recommended"] = bool(row.get("recommended_flag", False))
+        record["clerkship_recommended"] = question_flag(idx) == "recommended"
         exam_data.append(record)
     
     # Prepare a summary dictionary.
@@ -318,17 +322,51 @@ def save_exam_results():
         "student_name": st.session_state.user_name,
         "passcode": st.session_state.assigned_passcode,
         "score": st.session_state.score,
-        "total_questions": len(df),
+        "total_questions": len(records),
         "exam_data": exam_data,
-        "timestamp": firestore.SERVER_TIMESTAMP,
+        "timestamp": SERVER_TIMESTAMP,
     }
     
-    # Save to the "exam_results" collection.
-    db.collection("exam_results").add(exam_summary)
-    st.success("Thank you for your participation!")
+    # Save to the "exam_results" collection, keyed by the exam's completion
+    # token so that a retried completion overwrites instead of duplicating.
+    write_doc(db, "exam_results", st.session_state.completion_token, exam_summary, batch)
 
-    store_pending_recommendation_if_incorrect()
+    return store_pending_recommendation_if_incorrect(batch)
     
+def finalize_exam():
+    """
+    Completes the exam once and returns the summary the "Exam Completed" page
+    is rendered from; later reruns get the stored summary with no storage
+    calls. The complete state, the passcode lock, the stored result and any
+    pending repeat question are committed together, so a crash cannot leave a
+    locked passcode without a stored result. The result and the pending
+    repeat question are keyed by the completion token, so a retry after a
+    failed commit cannot duplicate them.
+    """
+    if st.session_state.completion_summary is not None:
+        return st.session_state.completion_summary
+    st.session_state.exam_complete = True
+    newly_locked = not is_passcode_locked(st.session_state.assigned_passcode, lock_hours=6)
+    batch = db.batch()
+    save_exam_state(db, batch)  # Save the complete state.
+    if newly_locked:
+        lock_passcode(st.session_state.assigned_passcode, batch)
+    pending_record_id = save_exam_results(batch)
+    try:
+        batch.commit()
+    except Exception:
+        # Nothing was written: rewrite the whole session document on retry.
+        st.session_state.saved_exam_state = {}
+        raise
+    if newly_locked:
+        remember_lock(st.session_state.assigned_passcode)
+    st.session_state.completion_summary = {
+        "newly_locked": newly_locked,
+        "pending_record_id": pending_record_id,
+        "email_sent": st.session_state.get("email_sent", False),
+    }
+    return st.session_state.completion_summary
+
 ### Login Screen
 
 def login_screen():
@@ -370,59 +408,36 @@ def login_screen():
         if "recipients" not in st.secrets:
             st.error("Recipient emails not configured. Please set them in your secrets file under [recipients].")
             return
-        if passcode_input not in st.secrets["recipients"]:
-            st.error("Invalid passcode. Please try again.")
+        registry = passcode_registry()
+        recipient = registry.get(passcode_input)
+        if recipient is None:
+            error = registry.error(passcode_input)
+            st.error(f"Error parsing passcode settings: {error}" if error else "Invalid passcode. Please try again.")
             return
 
         if is_passcode_locked(passcode_input, lock_hours=6):
             st.error("This passcode is locked for 6 hours. Please try again later.")
             return
             
-        # Save the login details in session state.
-        assigned_value = st.secrets["recipients"][passcode_input]
-
-        try:
-            email, start_date_str = assigned_value.split("|")
-        
-            rotation_start = datetime.datetime.strptime(start_date_str.strip(), "%Y-%m-%d")
-            expiration_date = rotation_start + datetime.timedelta(days=25)
-        
-            if datetime.datetime.today() > expiration_date:
-                st.error("This passcode has expired. Access is no longer allowed.")
-                return
-        except Exception as e:
-            st.error(f"Error parsing passcode settings: {e}")
+        # The rotation end date was parsed and converted when the registry was built.
+        if recipient.rotation_start is None:
+            st.error("Error parsing passcode settings: no rotation start date.")
+            return
+        if recipient.expired():
+            st.error("This passcode has expired. Access is no longer allowed.")
             return
         
         # If still valid, assign to session state
         st.session_state.assigned_passcode = passcode_input
-        st.session_state.recipient_email = email
-        st.session_state.user_name = email
+        st.session_state.recipient_email = recipient.email
+        st.session_state.user_name = recipient.email
         st.session_state.authenticated = True
 
         ######FIREBASE MUST BE WRITTEN AS A NUMBER... 19 = NUMBER, NOT STRING. 
         try:
-            # Retrieve all documents from the "recommendations" collection.
-            rec_docs = db.collection("recommendations").stream()
-            
-            # Convert each document to a dictionary and include the document ID (which may serve as a username).
-            recs_list = []
-            for doc in rec_docs:
-                rec_data = doc.to_dict()
-                recs_list.append(rec_data)
-            
-            # Convert the list of recommendation dictionaries into a DataFrame.
-            recs_df = pd.DataFrame(recs_list)
-            
-            # Display the DataFrame for debugging purposes.
-            #st.write("Recommendations DataFrame:", recs_df)
-            #st.stop()
-            
-            # Filter the DataFrame for the current user (assuming case-insensitive match).
-            user_recs = recs_df[recs_df["user_name"].str.lower() == st.session_state.user_name.lower()]
-            if not user_recs.empty:
-                unique_subjects = user_recs["subject"].dropna().unique()
-                unique_subjects = list(unique_subjects)
+            # Only this user's recommendations (case-insensitive match on the name).
+            unique_subjects = get_recommended_subjects(st.session_state.user_name)
+            if unique_subjects:
                 chosen_subject = random.choice(unique_subjects)
                 st.session_state.recommended_subject = chosen_subject
                 st.write(f"Recommended subject: {chosen_subject}")
@@ -433,60 +448,62 @@ def login_screen():
             st.session_state.recommended_subject = None
             st.warning("Error retrieving recommendations: " + str(e))
 
-        # Load the full dataset from CSVs.
-        full_df = load_data()  # Loads all CSV files.
+        # Load the shared question bank (parsed once per server process).
+        bank = get_question_bank()
+        pool = None  # bank positions to draw from; None means every question
         
-        # Optionally filter by subject based on designation in the passcode.
-        subject_mapping = {
-            "aaa": "Respiratory",
-            "aab": "School-Based",
-            # add more mappings as needed...
-        }
-        if "_" in passcode_input:
-            designation = passcode_input.split("_")[-1]  # get part after underscore
-            if designation in subject_mapping:
-                subject_filter = subject_mapping[designation]
-                filtered_df = full_df[full_df["subject"] == subject_filter]
-                if not filtered_df.empty:
-                    full_df = filtered_df
-                else:
-                    st.warning(f"No questions found for subject {subject_filter}. Using full dataset instead.")
+        # Optionally filter by subject, routed from the passcode's designation
+        # ([subject_routes] in the secrets). The bank is partitioned by subject
+        # when it is loaded, so this is a lookup.
+        if recipient.subject:
+            subject_positions = bank.subject_positions(recipient.subject)
+            if len(subject_positions):
+                pool = subject_positions
+            else:
+                st.warning(f"No questions found for subject {recipient.subject}. Using full dataset instead.")
         
         # Check for a saved exam session.
         user_key = str(st.session_state.assigned_passcode)
-        doc_ref = db.collection("exam_sessions").document(user_key)
-        doc = doc_ref.get()
+        data = db.get("exam_sessions", user_key)
 
-        if doc.exists:
-            data = doc.to_dict()
+        # Deleting a finished session and creating the new exam is one commit.
+        batch = db.batch()
+        if data is not None:
             # Check if the saved session is complete.
             if data.get("exam_complete", False):
-                # Exam was complete; now check if the lock period is still active.
-                if is_passcode_locked(passcode_input, lock_hours=6):
+                # Exam was complete; now check if the lock period is still active
+                # (re-read: another server process may have locked it).
+                if is_passcode_locked(passcode_input, lock_hours=6, fresh=True):
                     st.error("This passcode is locked. Please try again later.")
                     return
                 else:
                     # Lock period has expired—delete the old session and create a new exam.
-                    doc_ref.delete()
-                    create_new_exam(full_df)
+                    batch.delete("exam_sessions", user_key)
+                    create_new_exam(pool, batch)
             else:
                 # Resume the incomplete exam session.
                 st.session_state.question_index = data.get("question_index", 0)
                 st.session_state.score = data.get("score", 0)
                 st.session_state.results = data.get("results", [])
                 st.session_state.selected_answers = data.get("selected_answers", [])
-                st.session_state.result_messages = data.get("result_messages", [])
                 st.session_state.question_ids = data.get("question_ids", [])
+                st.session_state.completion_token = data.get("completion_token") or new_doc_id()
+                mark_exam_state_saved()
+                if not data.get("completion_token"):
+                    # Sessions saved before completion tokens get one now. It is
+                    # not stored yet, so the next save of the exam state writes it.
+                    del st.session_state.saved_exam_state["completion_token"]
                 if st.session_state.question_ids:
-                    qids = st.session_state.question_ids
-                    sample_df = full_df[full_df["record_id"].isin(qids)]
-                    sample_df = sample_df.set_index("record_id").loc[qids].reset_index()
-                    st.session_state.df = sample_df
+                    # Resolved from the ids, keeping the saved question order.
+                    st.session_state.bank_version = None
                 else:
-                    st.session_state.df = full_df
+                    # Sessions saved before question_ids were stored cannot be resumed.
+                    create_new_exam(pool, batch)
         else:
             # No saved session exists: create a new exam.
-            create_new_exam(full_df)
+            create_new_exam(pool, batch)
+        if len(batch):
+            batch.commit()
         
         st.rerun()
 
@@ -496,8 +513,8 @@ def exam_screen():
     st.title("Shelf Examination Application")
     st.write(f"Welcome, **{st.session_state.user_name}**!")
     
-    df = st.session_state.df
-    total_questions = len(df)
+    records = exam_records()
+    total_questions = len(records)
     
     with st.sidebar:
         st.header("Navigation")
@@ -509,17 +526,17 @@ def exam_screen():
                 marker = "❌"
             current_marker = " (Current)" if i == st.session_state.question_index else ""
 
-            row = st.session_state.df.iloc[i]
+            flag = question_flag(i)
 
             icons = ""
             
-            if row.get("pending_flag", False):
+            if flag == "pending":
                 icons += "🔴"
-            if row.get("recommended_flag", False):
+            if flag == "recommended":
                 icons += "⭐"
             
             # Only add the “– Repeat Question” text for pending
-            extra = "" if row.get("pending_flag", False) else ""
+            extra = "" if flag == "pending" else ""
             
             # Assemble the label
             label = f"Question {i+1}:{icons} {marker}{current_marker}{extra}"
@@ -533,152 +550,99 @@ def exam_screen():
         st.header("Exam Completed")
         st.write(f"Your final score is **{st.session_state.score}** out of **{total_questions}** ({percentage:.1f}%).")
         
-        # Mark the exam as complete.
-        st.session_state.exam_complete = True
-        save_exam_state()  # Save the complete state.
-        
-        # Lock the passcode if not already locked.
-        if not is_passcode_locked(st.session_state.assigned_passcode, lock_hours=6):
-            lock_passcode(st.session_state.assigned_passcode)
+        summary = finalize_exam()
+        st.success("Thank you for your participation!")
+        if summary["pending_record_id"]:
+            st.write(f"🔖 Stored pending question for record {summary['pending_record_id']} (re-admin in 48 h).")
+        if summary["newly_locked"]:
             st.success("Your passcode has now been locked for 6 hours and cannot be used again.")
         
-        # Send review email only once.
-        if not st.session_state.get("email_sent", False):
-            wrong_indices = [i for i, result in enumerate(st.session_state.results) if result == "incorrect"]
-            if wrong_indices:
-                selected_index = random.choice(wrong_indices)
-                selected_row = st.session_state.df.iloc[selected_index]
-                try:
-                    save_exam_state()
-                except Exception as e:
-                    st.error(f"Error: {e}")
-            else:
-                st.info("No incorrect answers to review!")
-        else:
+        if summary["email_sent"]:
             st.info("Review email has already been sent for this exam.")
-        
-        save_exam_results()
+        elif "incorrect" not in st.session_state.results:
+            st.info("No incorrect answers to review!")
         return
 
-    # Get the current row
-    current_row = df.iloc[st.session_state.question_index]
+    # Get the current question, and start loading the next one's image.
+    record = records[st.session_state.question_index]
+    if st.session_state.question_index + 1 < total_questions and records[st.session_state.question_index + 1]:
+        prefetch_question(records[st.session_state.question_index + 1])
 
     # Show banners for pending vs. recommended
-    if current_row.get("pending_flag", False):
+    if question_flag(st.session_state.question_index) == "pending":
         st.write("**🔴 Repeat Question**")
-    if current_row.get("recommended_flag", False):
+    if question_flag(st.session_state.question_index) == "recommended":
         st.write("**⭐ Clerkship Recommended**")
 
-    # Check if the current row has the expected keys. For example, verify "answerchoice_a" exists.
-    if "answerchoice_a" not in current_row:
+    # The question may have been removed from the bank since the exam was drawn.
+    if record is None:
         st.error("No further questions available for your exam. Please try again later.")
         st.stop()
-    
-    # Proceed as usual:
-    option_cols = [
-        ("a", current_row["answerchoice_a"]),
-        ("b", current_row["answerchoice_b"]),
-        ("c", current_row["answerchoice_c"]),
-        ("d", current_row["answerchoice_d"]),
-        ("e", current_row["answerchoice_e"]),
-    ]
-    options = []
-    option_mapping = {}
-    for letter, text in option_cols:
-        if pd.notna(text) and str(text).strip():
-            option_text = f"{letter.upper()}. {text.strip()}"
-            options.append(option_text)
-            option_mapping[option_text] = letter
 
     answered = st.session_state.selected_answers[st.session_state.question_index] is not None
-    default_index = 0
-    if answered:
-        selected_letter = st.session_state.selected_answers[st.session_state.question_index]
-        default_option = None
-        for opt, letter in option_mapping.items():
-            if letter == selected_letter:
-                default_option = opt
-                break
-        if default_option in options:
-            default_index = options.index(default_option)
     
     col1, col2 = st.columns(2)
     with col1:
-        st.write(f"**Question ({current_row['record_id']}):**")
-        st.write(current_row["question"])
-        record_id = current_row["record_id"]
-        image_path = get_image_path(record_id)
-        if image_path:
-            st.image(image_path, use_container_width=True)
-        st.write(current_row["anchor"])
+        st.write(f"**Question ({record.record_id}):**")
+        st.write(record.question)
+        assets = question_assets(record)
+        if assets.image:
+            st.image(assets.image, use_container_width=True)
+        st.write(record.anchor)
         st.write("**Select your answer:**")
-        answer_text_mapping = {}
-        letter_to_answer = {}
-        options = []
-        for letter in ["a", "b", "c", "d", "e"]:
-            col_name = "answerchoice_" + letter
-            if pd.notna(current_row[col_name]) and str(current_row[col_name]).strip():
-                text = str(current_row[col_name]).strip()
-                options.append(text)
-                answer_text_mapping[text] = letter
-                letter_to_answer[letter] = text
-        for i, option in enumerate(options):
+        for i, (selected_letter, option) in enumerate(zip(record.letters, record.options)):
             if not answered:
                 if st.button(option, key=f"option_{st.session_state.question_index}_{i}"):
-                    selected_letter = answer_text_mapping[option]
                     st.session_state.selected_answers[st.session_state.question_index] = selected_letter
-                    correct_answer_letter = str(current_row["correct_answer"]).strip().lower()
-                    if selected_letter == correct_answer_letter:
+                    if selected_letter == record.correct_letter:
                         st.session_state.results[st.session_state.question_index] = "correct"
-                        message = "Correct!"
                         st.session_state.score += 1
                     else:
                         st.session_state.results[st.session_state.question_index] = "incorrect"
-                        correct_answer_text = letter_to_answer.get(correct_answer_letter, "")
-                        message = f"Incorrect. The correct answer was: {correct_answer_text}"
-                    
-                    st.session_state.result_messages[st.session_state.question_index] = message
                     
-                    save_exam_state()
-                    st.rerun()
+                    save_exam_state(db)
+                    rerun(db)
             else:
                 st.button(option, key=f"option_{st.session_state.question_index}_{i}", disabled=True)
     
     with col2:
         if answered:
-            result_msg = st.session_state.result_messages[st.session_state.question_index]
             if st.session_state.results[st.session_state.question_index] == "correct":
-                st.success(result_msg)
+                st.success("Correct!")
             elif st.session_state.results[st.session_state.question_index] == "incorrect":
-                st.error(result_msg)
+                st.error(f"Incorrect. The correct answer was: {record.answer_text(record.correct_letter)}")
     
             st.write("**Explanation:**")
-            st.write(current_row["answer_explanation"])
+            st.write(record.explanation)
     
             # Check if this is the last question.
             if st.session_state.question_index == total_questions - 1:
                 # Last question: show "Submit and End Exam" button.
                 if st.button("Submit and End Exam"):
-                    st.session_state.exam_complete = True
                     st.session_state.question_index = total_questions  # Advance the index so the completed condition is met.
-                    save_exam_state()  # Save the final state.
-                    st.rerun()
+                    save_exam_state(db)  # Save the final state.
+                    rerun(db)
             else:
                 # For other questions, show "Next Question."
                 if st.button("Next Question"):
                     st.session_state.question_index += 1
                     st.session_state.result_message = ""
                     st.session_state.result_color = ""
-                    save_exam_state()
-                    st.rerun()
+                    save_exam_state(db)
+                    rerun(db)
 
 
 def main():
+    if admin_page(st.secrets, st.query_params):
+        return
     initialize_state()
     if not st.session_state.authenticated:
-        login_screen()
+        with trace_phase("login_screen"):
+            login_screen()
     else:
-        exam_screen()
+        with trace_phase("exam_screen"):
+            exam_screen()
+            flush_exam_state(db)
         
 if __name__ == "__main__":
     main()
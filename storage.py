@@ -0,0 +1,381 @@
+"""
+Storage backends for the exam apps.
+
+The apps code against the small document-store interface below instead of
+the Firestore client directly, so the whole exam flow can also run against a
+local SQLite (or in-memory) database for load tests and benchmarks.
+
+Documents are plain dicts addressed by (collection, doc_id). Values may be
+the SERVER_TIMESTAMP sentinel (stored as the commit time) and, in merge
+writes, DELETE_FIELD (removes that key), mirroring Firestore semantics.
+
+The backend is chosen by the SHELF_STORAGE environment variable, falling back
+to st.secrets["storage"]["backend"]:
+    firestore           Firebase project from st.secrets (default)
+    memory              private in-memory SQLite database
+    sqlite:<path>       SQLite file, shareable between processes
+"""
+import abc
+import base64
+import collections
+import datetime
+import json
+import operator
+import os
+import sqlite3
+import threading
+import uuid
+
+
+class _Sentinel:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+SERVER_TIMESTAMP = _Sentinel("SERVER_TIMESTAMP")
+DELETE_FIELD = _Sentinel("DELETE_FIELD")
+
+_OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def new_doc_id():
+    """
+    Random document id for new documents (what Firestore's .add() would pick).
+    """
+    return uuid.uuid4().hex[:20]
+
+
+class Storage(abc.ABC):
+    """
+    Interface the apps use. Queries take (field, op, value) filters and return
+    (doc_id, data) pairs.
+    """
+
+    @abc.abstractmethod
+    def get(self, collection, doc_id):
+        """Returns the document as a dict, or None if it does not exist."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set(self, collection, doc_id, data, merge=False):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, collection, doc_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def query(self, collection, filters=()):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def transform(self, collection, doc_id, func):
+        """
+        Reads the document and applies func(data) to it in one transaction.
+        func gets the document (None if missing) and returns merge updates,
+        or None to write nothing; it may run more than once if the document
+        changes concurrently. Returns the document after the update. Use
+        plain values in the updates (not SERVER_TIMESTAMP) so the returned
+        document is exact.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def batch(self):
+        """Returns a WriteBatch whose writes are applied atomically on commit()."""
+        raise NotImplementedError
+
+
+class WriteBatch(abc.ABC):
+    def __init__(self):
+        self._writes = []
+
+    def __len__(self):
+        return len(self._writes)
+
+    def set(self, collection, doc_id, data, merge=False):
+        self._writes.append(("set", collection, doc_id, data, merge))
+
+    def delete(self, collection, doc_id):
+        self._writes.append(("delete", collection, doc_id, None, False))
+
+    @abc.abstractmethod
+    def commit(self):
+        raise NotImplementedError
+
+
+### Firestore
+
+def _to_firestore(value):
+    from firebase_admin import firestore
+
+    if value is SERVER_TIMESTAMP:
+        return firestore.SERVER_TIMESTAMP
+    if value is DELETE_FIELD:
+        return firestore.DELETE_FIELD
+    if isinstance(value, dict):
+        return {key: _to_firestore(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_to_firestore(item) for item in value]
+    return value
+
+
+class FirestoreWriteBatch(WriteBatch):
+    def __init__(self, client):
+        super().__init__()
+        self._client = client
+
+    def commit(self):
+        if not self._writes:
+            return
+        batch = self._client.batch()
+        for kind, collection, doc_id, data, merge in self._writes:
+            ref = self._client.collection(collection).document(doc_id)
+            if kind == "set":
+                batch.set(ref, _to_firestore(data), merge=merge)
+            else:
+                batch.delete(ref)
+        batch.commit()
+        self._writes = []
+
+
+class FirestoreStorage(Storage):
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, collection, doc_id):
+        doc = self.client.collection(collection).document(doc_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    def set(self, collection, doc_id, data, merge=False):
+        self.client.collection(collection).document(doc_id).set(_to_firestore(data), merge=merge)
+
+    def delete(self, collection, doc_id):
+        self.client.collection(collection).document(doc_id).delete()
+
+    def query(self, collection, filters=()):
+        query = self.client.collection(collection)
+        for field, op, value in filters:
+            query = query.where(field, op, value)
+        return [(doc.id, doc.to_dict()) for doc in query.stream()]
+
+    def transform(self, collection, doc_id, func):
+        from firebase_admin import firestore
+
+        ref = self.client.collection(collection).document(doc_id)
+
+        @firestore.transactional
+        def run(transaction):
+            snapshot = ref.get(transaction=transaction)
+            data = snapshot.to_dict() if snapshot.exists else None
+            updates = func(data)
+            if updates:
+                transaction.set(ref, _to_firestore(updates), merge=True)
+                data = dict(data or {}, **updates)
+            return data
+
+        return run(self.client.transaction())
+
+    def batch(self):
+        return FirestoreWriteBatch(self.client)
+
+
+### Local SQLite stand-in
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return {"$ts": value.isoformat()}
+    if isinstance(value, bytes):
+        return {"$bytes": base64.b64encode(value).decode("ascii")}
+    if isinstance(value, dict):
+        return {key: _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if len(value) == 1 and "$ts" in value:
+            return datetime.datetime.fromisoformat(value["$ts"])
+        if len(value) == 1 and "$bytes" in value:
+            return base64.b64decode(value["$bytes"])
+        return {key: _decode(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+
+def _resolve(value, now):
+    if value is SERVER_TIMESTAMP:
+        return now
+    if isinstance(value, dict):
+        return {key: _resolve(item, now) for key, item in value.items() if item is not DELETE_FIELD}
+    if isinstance(value, (list, tuple)):
+        return [_resolve(item, now) for item in value]
+    return value
+
+
+def _merge(target, updates, now):
+    for key, value in updates.items():
+        if value is DELETE_FIELD:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value, now)
+        else:
+            target[key] = _resolve(value, now)
+
+
+class LocalWriteBatch(WriteBatch):
+    def __init__(self, storage):
+        super().__init__()
+        self._storage = storage
+
+    def commit(self):
+        if self._writes:
+            self._storage.op_counts["commit"] += 1
+            self._storage._apply(self._writes)
+        self._writes = []
+
+
+class LocalStorage(Storage):
+    """
+    SQLite-backed stand-in for Firestore. Every write (and every batch) runs
+    in one SQLite transaction, so a file database can be shared by several
+    processes. op_counts tallies the calls a Firestore client would have made
+    (get, set, delete, query, commit, transaction) for benchmarks.
+    """
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self.op_counts = collections.Counter()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            " collection TEXT NOT NULL, doc_id TEXT NOT NULL, data TEXT NOT NULL,"
+            " PRIMARY KEY (collection, doc_id))"
+        )
+
+    def _read(self, collection, doc_id):
+        row = self._conn.execute(
+            "SELECT data FROM documents WHERE collection = ? AND doc_id = ?", (collection, doc_id)
+        ).fetchone()
+        return _decode(json.loads(row[0])) if row else None
+
+    def _write(self, collection, doc_id, document):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO documents (collection, doc_id, data) VALUES (?, ?, ?)",
+            (collection, doc_id, json.dumps(_encode(document))),
+        )
+
+    def _apply(self, writes):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for kind, collection, doc_id, data, merge in writes:
+                    if kind == "delete":
+                        self._conn.execute(
+                            "DELETE FROM documents WHERE collection = ? AND doc_id = ?", (collection, doc_id)
+                        )
+                        continue
+                    if merge:
+                        document = self._read(collection, doc_id) or {}
+                        _merge(document, data, now)
+                    else:
+                        document = _resolve(data, now)
+                    self._write(collection, doc_id, document)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get(self, collection, doc_id):
+        self.op_counts["get"] += 1
+        with self._lock:
+            return self._read(collection, doc_id)
+
+    def set(self, collection, doc_id, data, merge=False):
+        self.op_counts["set"] += 1
+        self._apply([("set", collection, doc_id, data, merge)])
+
+    def delete(self, collection, doc_id):
+        self.op_counts["delete"] += 1
+        self._apply([("delete", collection, doc_id, None, False)])
+
+    def query(self, collection, filters=()):
+        self.op_counts["query"] += 1
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT doc_id, data FROM documents WHERE collection = ?", (collection,)
+            ).fetchall()
+        results = []
+        for doc_id, raw in rows:
+            data = _decode(json.loads(raw))
+            try:
+                if all(field in data and _OPERATORS[op](data[field], value) for field, op, value in filters):
+                    results.append((doc_id, data))
+            except TypeError:
+                continue  # Values of different types never match, as in Firestore.
+        return results
+
+    def transform(self, collection, doc_id, func):
+        self.op_counts["transaction"] += 1
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                data = self._read(collection, doc_id)
+                updates = func(data)
+                if updates:
+                    data = dict(data or {})
+                    _merge(data, updates, now)
+                    self._write(collection, doc_id, data)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return data
+
+    def batch(self):
+        return LocalWriteBatch(self)
+
+
+def open_storage(secrets=None):
+    """
+    Opens the backend selected by SHELF_STORAGE (or secrets["storage"]["backend"]).
+    The Firestore backend initialises firebase_admin from
+    secrets["firebase_service_account"] on first use.
+    """
+    backend = os.environ.get("SHELF_STORAGE")
+    if not backend and secrets is not None and "storage" in secrets:
+        backend = secrets["storage"].get("backend")
+    backend = backend or "firestore"
+
+    if backend == "memory":
+        return LocalStorage(":memory:")
+    if backend.startswith("sqlite:"):
+        return LocalStorage(backend[len("sqlite:"):])
+    if backend != "firestore":
+        raise ValueError(f"Unknown storage backend {backend!r}.")
+
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    if not firebase_admin._apps:
+        cred = credentials.Certificate(secrets["firebase_service_account"].to_dict())
+        firebase_admin.initialize_app(cred)
+    return FirestoreStorage(firestore.client())
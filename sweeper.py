@@ -0,0 +1,142 @@
+"""
+Expiry of old records, in batched deletes off the login path.
+
+    global_used_questions   entries older than USED_QUESTION_DAYS (shelf_app.py
+                            only reads the recent ones)
+    exam_sessions           sessions not written for SESSION_DAYS
+    locked_passcodes        legacy locks older than LOCK_HOURS (see
+                            passcode_status.py; the status documents are kept,
+                            their start time decides the weekly expiry)
+    email_outbox            messages sent more than OUTBOX_DAYS ago
+
+Run it from cron with `python maintenance.py sweep`, or let the apps run it
+in a background thread every st.secrets["maintenance"]["sweep_minutes"]
+(default 60; 0 disables the thread). Sweeps only delete what has expired,
+so overlapping runs from several processes are harmless. Each run also adds
+the user_key field to recommendation documents written since the last one
+(see recommendations.py).
+"""
+import collections
+import datetime
+import logging
+import threading
+
+from recommendations import backfill_recommendation_keys
+from tracing import trace_phase
+
+logger = logging.getLogger(__name__)
+
+USED_QUESTION_DAYS = 7
+SESSION_DAYS = 30
+LOCK_HOURS = 6
+OUTBOX_DAYS = 7
+SWEEP_MINUTES = 60
+# Firestore allows at most 500 writes per batch.
+BATCH_SIZE = 400
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class _BatchedDeletes:
+    def __init__(self, db, batch_size):
+        self.db = db
+        self.batch_size = batch_size
+        self.batch = db.batch()
+        self.counts = collections.Counter()
+
+    def delete(self, collection, doc_id):
+        self.batch.delete(collection, doc_id)
+        self.counts[collection] += 1
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.batch):
+            self.batch.commit()
+            self.batch = self.db.batch()
+
+
+def sweep_expired(db, now=None, batch_size=BATCH_SIZE):
+    """
+    Deletes the expired records in batches of batch_size. Returns a Counter
+    of documents deleted per collection.
+    """
+    now = now or _now()
+    writer = _BatchedDeletes(db, batch_size)
+
+    # Single-field range filters: no composite Firestore indexes needed.
+    used_cutoff = now - datetime.timedelta(days=USED_QUESTION_DAYS)
+    for doc_id, _ in db.query("global_used_questions", [("timestamp", "<", used_cutoff)]):
+        writer.delete("global_used_questions", doc_id)
+
+    session_cutoff = now - datetime.timedelta(days=SESSION_DAYS)
+    for doc_id, _ in db.query("exam_sessions", [("timestamp", "<", session_cutoff)]):
+        writer.delete("exam_sessions", doc_id)
+
+    lock_cutoff = now - datetime.timedelta(hours=LOCK_HOURS)
+    for doc_id, _ in db.query("locked_passcodes", [("lock_time", "<", lock_cutoff)]):
+        writer.delete("locked_passcodes", doc_id)
+
+    outbox_cutoff = now - datetime.timedelta(days=OUTBOX_DAYS)
+    for doc_id, _ in db.query("email_outbox", [("sent_at", "<", outbox_cutoff)]):
+        writer.delete("email_outbox", doc_id)
+
+    writer.flush()
+    return writer.counts
+
+
+def sweep_minutes(secrets):
+    if "maintenance" not in secrets:
+        return SWEEP_MINUTES
+    return float(secrets["maintenance"].get("sweep_minutes", SWEEP_MINUTES) or 0)
+
+
+class SweeperThread(threading.Thread):
+    """
+    Daemon thread that runs sweep_expired() every interval_seconds, starting
+    one interval after it is started.
+    """
+
+    def __init__(self, db, interval_seconds):
+        super().__init__(name="record-sweeper", daemon=True)
+        self.db = db
+        self.interval_seconds = interval_seconds
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        while not self._stopping.wait(self.interval_seconds):
+            try:
+                with trace_phase("sweeper"):
+                    counts = sweep_expired(self.db)
+                    keyed = backfill_recommendation_keys(self.db)
+                if counts:
+                    logger.info("record sweeper: deleted %s", dict(counts))
+                if keyed:
+                    logger.info("record sweeper: added user_key to %d recommendations", keyed)
+            except Exception:
+                logger.exception("record sweeper: sweep failed")
+
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def start_sweeper(db, secrets):
+    """
+    Starts the process-wide sweeper thread on first call and returns it, or
+    None when sweeping is disabled.
+    """
+    global _sweeper
+    minutes = sweep_minutes(secrets)
+    if minutes <= 0:
+        return None
+    with _sweeper_lock:
+        if _sweeper is None or not _sweeper.is_alive():
+            _sweeper = SweeperThread(db, minutes * 60)
+            _sweeper.start()
+        return _sweeper
@@ -0,0 +1,82 @@
+import datetime
+
+import pytest
+
+import outbox
+from outbox import CLAIM_SECONDS, MAX_ATTEMPTS, backoff, claim_message, drain_outbox, enqueue_email
+from storage import LocalStorage
+
+
+class FakePool:
+    settings = {"from_email": "exams@example.org"}
+
+    def __init__(self, error=None):
+        self.error = error
+        self.sent = []
+
+    def send(self, msg, to_addrs):
+        if self.error is not None:
+            raise self.error
+        self.sent.append((msg["Subject"], to_addrs))
+
+
+@pytest.fixture
+def db():
+    return LocalStorage(":memory:")
+
+
+def later(seconds):
+    return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=seconds)
+
+
+def test_sends_due_messages_once(db):
+    message_id = enqueue_email(db, ["a@example.org"], "Review", "body", attachment=b"docx", filename="r.docx")
+    pool = FakePool()
+    assert drain_outbox(db, pool) == (1, 0)
+    assert pool.sent == [("Review", ["a@example.org"])]
+    record = db.get(outbox.COLLECTION, message_id)
+    assert record["status"] == "sent"
+    assert "attachment" not in record
+    assert "claimed_by" not in record and "claimed_until" not in record
+    assert drain_outbox(db, pool) == (0, 0)
+
+
+def test_claim_is_exclusive_until_it_expires(db):
+    message_id = enqueue_email(db, ["a@example.org"], "Review", "body")
+    assert claim_message(db, message_id) is not None
+    assert claim_message(db, message_id) is None
+    assert drain_outbox(db, FakePool()) == (0, 0)
+    # A worker that died holding the claim does not block the message for good.
+    assert claim_message(db, message_id, now=later(CLAIM_SECONDS + 1)) is not None
+
+
+def test_failed_send_backs_off(db):
+    message_id = enqueue_email(db, ["a@example.org"], "Review", "body")
+    assert drain_outbox(db, FakePool(OSError("connection refused"))) == (0, 1)
+    record = db.get(outbox.COLLECTION, message_id)
+    assert record["status"] == "pending"
+    assert record["attempts"] == 1
+    assert record["last_error"] == "connection refused"
+    assert "claimed_until" not in record
+    assert record["next_attempt_at"] > later(backoff(1) - 5)
+
+    # Not retried before it is due.
+    pool = FakePool()
+    assert drain_outbox(db, pool) == (0, 0)
+    assert drain_outbox(db, pool, now=later(backoff(1) + 1)) == (1, 0)
+
+
+def test_backoff_doubles_up_to_the_cap():
+    assert [backoff(n) for n in (1, 2, 3)] == [30, 60, 120]
+    assert backoff(20) == outbox.MAX_BACKOFF_SECONDS
+
+
+def test_gives_up_after_max_attempts(db):
+    message_id = enqueue_email(db, ["a@example.org"], "Review", "body")
+    pool = FakePool(OSError("down"))
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        assert drain_outbox(db, pool, now=later(outbox.MAX_BACKOFF_SECONDS * attempt)) == (0, 1)
+    record = db.get(outbox.COLLECTION, message_id)
+    assert record["status"] == "failed"
+    assert record["attempts"] == MAX_ATTEMPTS
+    assert drain_outbox(db, FakePool(), now=later(10 * outbox.MAX_BACKOFF_SECONDS)) == (0, 0)
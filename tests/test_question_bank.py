@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from question_bank import (QuestionBank, build_question_bank, compile_bank, encode_bank,
+                           open_compiled_bank, read_csv_bank, source_fingerprint)
+
+
+def make_df(n=5):
+    return pd.DataFrame({
+        "record_id": [f"R{i}" for i in range(n)],
+        "question": [f"Question {i} – ünïcode" for i in range(n)],
+        "anchor": [None if i % 2 else f"Anchor {i}" for i in range(n)],
+        "correct_answer": ["a"] * n,
+        "subject": ["Respiratory" if i % 2 else "Cardiology" for i in range(n)],
+    })
+
+
+def plain_rows(df):
+    # Empty CSV cells decode as None.
+    return [{k: (None if pd.isna(v) else v) for k, v in row.items()} for row in df.to_dict("records")]
+
+
+def test_round_trip_in_memory():
+    df = make_df()
+    bank = QuestionBank(encode_bank(df, ()))
+    assert len(bank) == len(df)
+    assert bank.columns == list(df.columns)
+    assert [bank.row(pos) for pos in range(len(bank))] == plain_rows(df)
+    assert bank.value("anchor", 1) is None
+    assert sorted(bank.subjects) == ["Cardiology", "Respiratory"]
+    assert list(bank.subject_positions("Respiratory")) == [1, 3]
+    assert len(bank.subject_positions("Missing")) == 0
+    taken = bank.take([3, 0])
+    assert list(taken["record_id"]) == ["R3", "R0"]
+    assert pd.isna(taken["anchor"].iat[0])
+
+
+def test_compiled_file_round_trip(tmp_path):
+    csv_path = tmp_path / "bank.csv"
+    make_df().to_csv(csv_path, index=False)
+    pattern = str(tmp_path / "*.csv")
+    out_path = str(tmp_path / "bank.bin")
+
+    compile_bank(pattern, out_path)
+    compiled = open_compiled_bank(out_path)
+    expected = read_csv_bank([str(csv_path)])
+    assert compiled.fingerprint == source_fingerprint(pattern)
+    assert [compiled.row(pos) for pos in range(len(compiled))] == plain_rows(expected)
+
+    # build_question_bank maps the file while it matches the CSVs...
+    assert build_question_bank(pattern, out_path).source == "compiled"
+    # ...and parses the CSVs again once they change.
+    make_df(6).to_csv(csv_path, index=False)
+    rebuilt = build_question_bank(pattern, out_path)
+    assert rebuilt.source == "csv"
+    assert len(rebuilt) == 6
+
+
+def test_rejects_foreign_buffer():
+    with pytest.raises(ValueError):
+        QuestionBank(b"NOTABANK" + bytes(64))
+
+
+def test_index_finds_every_record_id():
+    # Enough rows that the crc32 slots collide and probing is exercised.
+    df = pd.DataFrame({"record_id": [str(i) for i in range(2000)]})
+    bank = QuestionBank(encode_bank(df, ()))
+    assert all(bank.position(str(i)) == i for i in range(2000))
+
+
+def test_index_missing_and_duplicate_record_ids():
+    df = pd.DataFrame({"record_id": ["A", "B", "A", "C"], "question": ["first", "b", "second", "c"]})
+    bank = QuestionBank(encode_bank(df, ()))
+    # The first row with a duplicated record_id wins.
+    assert bank.position("A") == 0
+    assert bank.position("C") == 3
+    assert bank.position("missing") is None
+    assert bank.positions(["C", "missing", "A"]) == [3, 0]
+
+
+def test_record_ids_added_when_missing(tmp_path):
+    csv_path = tmp_path / "bank.csv"
+    pd.DataFrame({"question": ["x", "y"]}).to_csv(csv_path, index=False)
+    bank = QuestionBank(encode_bank(read_csv_bank([str(csv_path)]), ()))
+    assert [bank.value("record_id", pos) for pos in range(2)] == ["1", "2"]
+    assert bank.position("2") == 1
+
+
+def test_lazy_dataframe_matches_rows():
+    df = make_df()
+    bank = QuestionBank(encode_bank(df, ()))
+    assert bank._df is None
+    decoded = bank.df
+    assert list(decoded["record_id"]) == list(df["record_id"])
+    assert np.isnan(decoded["anchor"].iat[1])
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+from question_bank import QuestionBank, encode_bank
+from question_sampler import sample_positions
+
+
+def make_bank(n=100):
+    return QuestionBank(encode_bank(pd.DataFrame({
+        "record_id": [str(i) for i in range(n)],
+        "subject": [str(i % 4) for i in range(n)],
+    }), ()))
+
+
+def test_seeded_draws_are_reproducible():
+    bank = make_bank()
+    first = sample_positions(bank, 10, rng=np.random.default_rng(42))
+    second = sample_positions(bank, 10, rng=np.random.default_rng(42))
+    assert first == second
+    assert first != sample_positions(bank, 10, rng=np.random.default_rng(43))
+
+
+def test_draws_are_distinct_and_respect_pool_and_exclusions():
+    bank = make_bank()
+    pool = np.arange(20, 60)
+    exclude = list(range(20, 50))
+    for seed in range(20):
+        picked = sample_positions(bank, 8, pool=pool, exclude=exclude, rng=np.random.default_rng(seed))
+        assert len(picked) == 8
+        assert len(set(picked)) == 8
+        assert all(50 <= pos < 60 for pos in picked)
+
+
+def test_returns_what_is_left_when_short():
+    bank = make_bank(10)
+    picked = sample_positions(bank, 5, exclude=range(7), rng=np.random.default_rng(0))
+    assert sorted(picked) == [7, 8, 9]
+    assert sample_positions(bank, 5, exclude=range(10), rng=np.random.default_rng(0)) == []
+
+
+def test_quotas_are_filled_from_subject_partitions():
+    bank = make_bank()
+    picked = sample_positions(bank, 6, quotas={"1": 3}, exclude=[1, 5], rng=np.random.default_rng(7))
+    assert len(picked) == 6
+    assert len(set(picked)) == 6
+    assert all(pos % 4 == 1 for pos in picked[:3])
+    assert not {1, 5} & set(picked)
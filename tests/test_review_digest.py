@@ -0,0 +1,64 @@
+import datetime
+import threading
+
+import outbox
+from review_digest import COLLECTION, QUESTION_FIELDS, claim_items, enqueue_review_item, flush_digests
+from storage import LocalStorage
+
+WINDOW = datetime.timedelta(minutes=10)
+
+
+def add_items(db, count, recipient="preceptor@example.org"):
+    row = {field: f"{field} text" for field in QUESTION_FIELDS}
+    row["correct_answer"] = "a"
+    for i in range(count):
+        enqueue_review_item(db, recipient, f"student{i}", row, "b")
+
+
+def later(minutes):
+    return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=minutes)
+
+
+def test_queues_one_digest_once_due():
+    db = LocalStorage(":memory:")
+    add_items(db, 3)
+    assert flush_digests(db, WINDOW) == 0
+    assert flush_digests(db, WINDOW, now=later(11)) == 1
+    assert db.query(COLLECTION) == []
+    (message_id, message), = db.query(outbox.COLLECTION)
+    assert message["to"] == ["preceptor@example.org"]
+    assert message["attachment"]
+    assert flush_digests(db, WINDOW, now=later(11)) == 0
+
+
+def test_claimed_items_are_left_to_their_holder():
+    db = LocalStorage(":memory:")
+    add_items(db, 3)
+    now = later(11)
+    assert len(claim_items(db, db.query(COLLECTION), now)) == 3
+    assert flush_digests(db, WINDOW, now=now) == 0
+    assert db.query(outbox.COLLECTION) == []
+    # Once the claim has lapsed (its worker died) the items are sent.
+    assert flush_digests(db, WINDOW, now=later(11 + outbox.CLAIM_SECONDS / 60 + 1)) == 1
+
+
+def test_concurrent_flushes_send_each_item_once(tmp_path):
+    path = str(tmp_path / "db.sqlite")
+    add_items(LocalStorage(path), 3)
+    now = later(11)
+    start = threading.Barrier(4)
+
+    def flush():
+        db = LocalStorage(path)
+        start.wait()
+        flush_digests(db, WINDOW, now=now)
+
+    threads = [threading.Thread(target=flush) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    db = LocalStorage(path)
+    messages = db.query(outbox.COLLECTION)
+    assert db.query(COLLECTION) == []
+    assert sum(int(m["subject"].split("(")[1].split()[0]) for _, m in messages) == 3
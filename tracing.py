@@ -0,0 +1,329 @@
+"""
+Timing spans for the storage and SMTP calls.
+
+Every storage call (get, set, delete, query, transaction, batch commit)
+made through a TracedStorage, and every SMTP connect/send made by the
+outbox's SMTPPool, records a span: operation name, collection, latency,
+payload size and the phase it ran in. Phases are the app steps that make
+the calls (login_screen, exam_screen, the outbox and sweeper threads), so
+the spans show which round trips make up a slow login.
+
+Spans are aggregated in process into a latency histogram per
+(phase, operation, collection), and the most recent ones are kept for
+export as JSON lines. Both are shown on the ?traces admin page (admin.py).
+Set SHELF_TRACE_FILE to also append every span to a JSONL file, and
+summarize such a file with
+    python tracing.py trace.jsonl
+"""
+import argparse
+import bisect
+import collections
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+
+from storage import Storage
+
+# Histogram bucket upper bounds in milliseconds; the last bucket is open.
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+RECENT_SPANS = 5000
+
+Span = collections.namedtuple(
+    "Span", ["phase", "name", "collection", "started", "duration_ms", "payload_bytes", "ok"]
+)
+
+_phase = contextvars.ContextVar("trace_phase", default="")
+
+
+def payload_size(value):
+    """
+    Approximate serialized size of a document, query result or message
+    part, in bytes. Strings count their length and other scalars 8 bytes.
+    """
+    total = 0
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, (str, bytes, bytearray)):
+            total += len(value)
+        elif isinstance(value, dict):
+            total += sum(len(str(key)) for key in value)
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+        elif value is not None:
+            total += 8
+    return total
+
+
+def message_size(msg):
+    """
+    Size of an email.message's encoded parts, without serializing it again.
+    """
+    return sum(len(part.get_payload()) for part in msg.walk() if not part.is_multipart())
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.payload_bytes = 0
+
+    def add(self, span):
+        self.counts[bisect.bisect_left(BUCKETS_MS, span.duration_ms)] += 1
+        self.count += 1
+        self.errors += not span.ok
+        self.total_ms += span.duration_ms
+        self.max_ms = max(self.max_ms, span.duration_ms)
+        self.payload_bytes += span.payload_bytes
+
+    def percentile(self, q):
+        """
+        Upper bound of the bucket holding the q-th percentile (max_ms for
+        the open bucket).
+        """
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return float(BUCKETS_MS[i]) if i < len(BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def mean(self):
+        return self.total_ms / self.count if self.count else 0.0
+
+
+class Tracer:
+    """
+    Collects spans from every thread of the process.
+    """
+
+    def __init__(self, export_path=None, recent=RECENT_SPANS):
+        self.export_path = export_path
+        self.histograms = collections.defaultdict(Histogram)
+        self.recent = collections.deque(maxlen=recent)
+        self._lock = threading.Lock()
+
+    def record(self, span):
+        with self._lock:
+            self.histograms[(span.phase, span.name, span.collection)].add(span)
+            self.recent.append(span)
+            if self.export_path:
+                with open(self.export_path, "a") as f:
+                    f.write(span_json(span) + "\n")
+
+    @contextlib.contextmanager
+    def span(self, name, collection="", payload_bytes=0):
+        """
+        Times the enclosed call. The yielded dict's "payload_bytes" may be
+        set inside the block once the size is known (e.g. a query result).
+        """
+        info = {"payload_bytes": payload_bytes}
+        started = time.time()
+        start = time.perf_counter()
+        ok = True
+        try:
+            yield info
+        except Exception:
+            # Not BaseException: st.rerun() and st.stop() unwind through here.
+            ok = False
+            raise
+        finally:
+            duration_ms = (time.perf_counter() - start) * 1000
+            self.record(Span(_phase.get(), name, collection, started, duration_ms, info["payload_bytes"], ok))
+
+    def snapshot(self):
+        """
+        [(phase, name, collection, Histogram)], slowest total time first.
+        """
+        with self._lock:
+            rows = [(*key, histogram) for key, histogram in self.histograms.items()]
+        return sorted(rows, key=lambda row: row[3].total_ms, reverse=True)
+
+    def recent_spans(self):
+        with self._lock:
+            return list(self.recent)
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.recent.clear()
+
+
+def span_json(span):
+    return json.dumps(span._asdict(), separators=(",", ":"))
+
+
+tracer = Tracer(os.environ.get("SHELF_TRACE_FILE") or None)
+
+
+@contextlib.contextmanager
+def trace_phase(name):
+    """
+    Labels the spans recorded inside the block with phase name, and records
+    the phase itself as a span, so its total can be compared with the calls
+    it made.
+    """
+    token = _phase.set(name)
+    try:
+        with tracer.span("phase", name):
+            yield
+    finally:
+        _phase.reset(token)
+
+
+### Storage wrapper
+
+class TracedWriteBatch:
+    def __init__(self, batch):
+        self._batch = batch
+        self._collections = []
+        self._payload_bytes = 0
+
+    def __len__(self):
+        return len(self._batch)
+
+    def set(self, collection, doc_id, data, merge=False):
+        self._collections.append(collection)
+        self._payload_bytes += payload_size(data)
+        self._batch.set(collection, doc_id, data, merge=merge)
+
+    def delete(self, collection, doc_id):
+        self._collections.append(collection)
+        self._batch.delete(collection, doc_id)
+
+    def commit(self):
+        collections_ = ",".join(sorted(set(self._collections)))
+        with tracer.span("commit", collections_, self._payload_bytes):
+            self._batch.commit()
+        self._collections = []
+        self._payload_bytes = 0
+
+
+class TracedStorage(Storage):
+    """
+    Storage that records a span for every call to the wrapped backend.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    def __getattr__(self, name):
+        # Backend extras such as LocalStorage.op_counts.
+        return getattr(self.inner, name)
+
+    def get(self, collection, doc_id):
+        with tracer.span("get", collection) as span:
+            data = self.inner.get(collection, doc_id)
+            span["payload_bytes"] = payload_size(data)
+        return data
+
+    def set(self, collection, doc_id, data, merge=False):
+        with tracer.span("set", collection, payload_size(data)):
+            self.inner.set(collection, doc_id, data, merge=merge)
+
+    def delete(self, collection, doc_id):
+        with tracer.span("delete", collection):
+            self.inner.delete(collection, doc_id)
+
+    def query(self, collection, filters=()):
+        with tracer.span("query", collection) as span:
+            results = self.inner.query(collection, filters)
+            span["payload_bytes"] = payload_size([data for _, data in results])
+        return results
+
+    def transform(self, collection, doc_id, func):
+        with tracer.span("transaction", collection) as span:
+            data = self.inner.transform(collection, doc_id, func)
+            span["payload_bytes"] = payload_size(data)
+        return data
+
+    def batch(self):
+        return TracedWriteBatch(self.inner.batch())
+
+
+### Reports
+
+def summary_rows(rows):
+    """
+    Plain dicts for display, from (phase, name, collection, Histogram) rows.
+    """
+    return [{
+        "phase": phase,
+        "operation": name,
+        "collection": collection,
+        "calls": h.count,
+        "errors": h.errors,
+        "mean ms": round(h.mean(), 1),
+        "p50 ms": h.percentile(50),
+        "p95 ms": h.percentile(95),
+        "p99 ms": h.percentile(99),
+        "max ms": round(h.max_ms, 1),
+        "total ms": round(h.total_ms, 1),
+        "KiB": round(h.payload_bytes / 1024, 1),
+    } for phase, name, collection, h in rows]
+
+
+def load_jsonl(path):
+    histograms = collections.defaultdict(Histogram)
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                span = Span(**json.loads(line))
+                histograms[(span.phase, span.name, span.collection)].add(span)
+    rows = [(*key, histogram) for key, histogram in histograms.items()]
+    return sorted(rows, key=lambda row: row[3].total_ms, reverse=True)
+
+
+def traces_page(secrets):
+    """
+    Admin-only page with the span histograms of this process.
+    """
+    import pandas as pd
+    import streamlit as st
+
+    from admin import require_admin
+
+    st.title("Call Timings")
+    if not require_admin(secrets):
+        return
+
+    rows = summary_rows(tracer.snapshot())
+    if not rows:
+        st.write("No calls recorded yet.")
+        return
+    st.write("Histogram bucket bounds (ms): " + ", ".join(str(b) for b in BUCKETS_MS)
+             + ". Percentiles are bucket upper bounds.")
+    st.dataframe(pd.DataFrame(rows), hide_index=True)
+    spans = tracer.recent_spans()
+    st.download_button("Download recent spans (JSON lines)", "\n".join(span_json(s) for s in spans) + "\n",
+                       file_name="spans.jsonl", mime="application/jsonl")
+    if st.button("Reset"):
+        tracer.reset()
+        st.rerun()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a span file written with SHELF_TRACE_FILE.")
+    parser.add_argument("path")
+    args = parser.parse_args()
+
+    columns = ("phase", "operation", "collection", "calls", "p50 ms", "p95 ms", "p99 ms", "max ms", "total ms", "KiB")
+    rows = summary_rows(load_jsonl(args.path))
+    widths = {c: max([len(c)] + [len(str(row[c])) for row in rows]) for c in columns}
+    print("  ".join(c.rjust(widths[c]) for c in columns))
+    for row in rows:
+        print("  ".join(str(row[c]).rjust(widths[c]) for c in columns))
+
+
+if __name__ == "__main__":
+    main()